@@ -9,11 +9,12 @@
 #################################################
 
 
-import os, sys, subprocess, json
+import os, sys, stat, json, hashlib, struct, selectors, signal, shlex, heapq, tempfile, csv, random, queue, marshal, copy, socket, errno
+from array import array
+from collections import deque
 from json import JSONDecodeError
-from threading import Thread
-from time import sleep
-from evdev import InputDevice, uinput, categorize, ecodes
+from threading import Thread, Lock, Condition
+from time import sleep, monotonic, time, perf_counter_ns
 
 
 ##########
@@ -30,6 +31,26 @@ exit_key_def = "KEY_ESC" # Default exit key in a newly added device.
 first_layer_def = "main" # Default name for the first layer in a newly added device.
 exit_cmd_default = "echo Keysboard has exited!" # Default command for each newly generated layer to run on exit.
 hold_time_def = 0.1 # Default hold time for simulated keypresses (used if nothing is specified in the config).
+record_stop_key_def = "KEY_ESC" # Key that stops recording a macro, it isn't recorded itself.
+config_poll_interval_def = 1.0 # Seconds between config file checks when inotify is unavailable.
+input_dir_def = "/dev/input" # Where input devices appear, watched for devices being plugged in.
+config_cache_def = True # Whether to keep a compiled copy of the config next to it (as config_file.cache) for fast startup.
+engine_def = "threaded" # Default engine, "threaded" runs one thread per device, "async" runs every device on one asyncio event loop, "supervisor" runs one worker process per device.
+supervisor_backoff_min_def = 0.5 # Seconds before the supervisor restarts a crashed worker, doubled for every crash in a row.
+supervisor_backoff_max_def = 30.0 # Longest wait before restarting a crashed worker.
+supervisor_stable_time_def = 10.0 # Seconds a worker has to run before its crashes stop counting as in a row.
+supervisor_stop_timeout_def = 5.0 # Seconds workers get to release their devices and exit before they are killed.
+log_level_def = "debug" # Default level for messages not filtered by a device's own log_level, one of debug, info, warning, error, off.
+log_format_def = "text" # Default log format, "text" or "json" for one JSON object per line.
+log_queue_size_def = 4096 # Log messages waiting to be written before new ones are dropped instead of blocking.
+log_coalesce_interval_def = 1.0 # Seconds during which repeats of the same key press message are counted instead of written.
+stats_file_def = os.path.expanduser("~/.cache/keysboard/stats.json") # Default latency stats file read by the show-stats command.
+stats_interval_def = 10.0 # Seconds between latency stats file writes when stats are enabled.
+executor_queue_depth_def = 64 # Default maximum number of keyboard actions per device waiting to play before the full policy applies, and of commands per device running at once before new ones are dropped.
+shell_def = "/bin/sh" # Shell used to run "shell" actions. "exec" actions run their command directly, without a shell.
+executor_full_policy_def = "drop" # Default policy for a full keyboard action queue, "drop" drops the new action, "coalesce" plays it in place of the newest waiting one.
+control_socket_def = os.path.join(os.environ.get("XDG_RUNTIME_DIR", "") or os.path.expanduser("~/.cache/keysboard"), "keysboard.sock") # Unix socket a running keysboard listens on for commands. Can be overridden from the command line, "off" disables it.
+control_timeout_def = 2.0 # Seconds to wait for a running keysboard to answer a command.
 ##########
 
 
@@ -40,13 +61,16 @@ hold_time_def = 0.1 # Default hold time for simulated keypresses (used if nothin
 # Action Types
 action_set_layer_tag = "set_layer"
 action_shell_tag = "shell"
+action_exec_tag = "exec"
 action_keyboard_tag = "keyboard"
 action_alias_tag = "alias"
 action_multi_tag = "multi"
+action_macro_tag = "macro"
 
 # Devices
 devices_tag = "devices"
 device_nickname_tag = "device_nickname"
+device_name_tag = "device_name" # Optional, attaches any input device with this name when the device's own path doesn't exist.
 aliases_tag = "aliases"
 exit_key_tag = "exit_key"
 exit_cmd_tag = "exit_cmd"
@@ -56,10 +80,20 @@ layers_tag = "layers"
 first_layer_tag = "first_layer"
 keybinds_tag = "keybinds"
 inherit_tag = "inherit"
+bind_defaults_tag = "bind_defaults"
+
+# Keybind Options
+debounce_tag = "debounce"
+repeat_rate_tag = "repeat_rate"
+max_in_flight_tag = "max_in_flight"
+coalesce_tag = "coalesce"
 
 # Printing
-print_key_codes_tag = "print_key_codes"
+print_key_codes_tag = "print_key_codes" # Kept for old configs, log_level replaces both.
 print_actions_tag = "print_actions"
+log_level_tag = "log_level"
+log_format_json_tag = "json"
+log_format_text_tag = "text"
 
 # Actions
 action_type_tag = "action_type"
@@ -71,12 +105,63 @@ key_tag = "key"
 hold_time_tag = "hold_time"
 delay_tag = "delay"
 set_key_tag = "set_key"
+speed_tag = "speed"
+
+# Compiled Devices
+keymaps_tag = "keymaps"
+bind_options_tag = "bind_options"
+exit_codes_tag = "exit_codes"
+compile_warnings_tag = "warnings" # (device, layer, msg) warnings from compiling, logged again when loaded from the cache.
+
+# Action Executor
+executor_tag = "executor"
+workers_tag = "workers" # No longer used, keyboard actions play on one scheduler thread and commands aren't run on threads.
+queue_depth_tag = "queue_depth"
+full_policy_tag = "full_policy"
+full_policy_drop_tag = "drop"
+full_policy_coalesce_tag = "coalesce"
+
+# Engines
+engine_threaded_tag = "threaded"
+engine_async_tag = "async"
+engine_supervisor_tag = "supervisor"
+
+# Latency Stats
+stage_queue_tag = "queue"
+stage_resolve_tag = "resolve"
+stage_action_start_tag = "action_start"
+stage_output_tag = "output"
+stats_devices_tag = "devices"
+stats_layers_tag = "layers"
+stats_actions_tag = "actions"
+stats_histograms_tag = "histograms"
+stats_counters_tag = "counters"
+
+# Control Socket
+control_off_tag = "off"
+control_command_tag = "command"
+control_ok_tag = "ok"
+control_error_tag = "error"
+control_save_tag = "save"
+control_config_file_tag = "config_file"
 
 # Other
 backup_tag = "backup"
 ##########
 
 ##########
+log_debug = 10
+log_info = 20
+log_warning = 30
+log_error = 40
+log_levels = {"debug": log_debug, "info": log_info, "warning": log_warning, "error": log_error, "off": 100}
+log_level_names = {level: name for name, level in log_levels.items()}
+
+def shorten_name(name):
+    if shorten_name_amount != -1 and len(name) > shorten_name_amount:
+        return name[:shorten_name_amount] + "..."
+    return name
+
 def gen_log_msg(device="", current_layer="", msg="", exclude_empty=True):
     if exclude_empty and device == "":
         device_msg = ""
@@ -95,35 +180,812 @@ def gen_log_msg(device="", current_layer="", msg="", exclude_empty=True):
     return f"{device_layer_msg}{msg}"
 
 
-def exec_cmd(cmd, device="", current_layer="", print_output=True):
-    output = str(subprocess.run(cmd, shell=True, start_new_session=True, stdout=subprocess.PIPE).stdout.decode("utf-8"))
-    if print_output and output != "" and output != "\n":
+class Logger():
+    # Log records go on a bounded queue and are written by a background thread, so logging never blocks
+    # a device thread on a slow terminal or pipe. When the queue is full, records are dropped and counted.
+    # Repeats of a coalescing record (key presses) within log_coalesce_interval_def are written as one count.
+    def __init__(self, level=log_levels[log_level_def], json_lines=log_format_def == log_format_json_tag, queue_size=log_queue_size_def):
+        self.level = level
+        self.json_lines = json_lines
+        self.queue = queue.Queue(queue_size)
+        self.lock = Lock()
+        self.thread = None
+        self.threaded = True # Without the writer thread, records are written right away by whoever logs them.
+        self.dropped = 0
+        self.device_levels = {} # Name a device is logged under -> its own log_level, see set_device_levels().
+
+    def set_device_levels(self, devices):
+        # Devices are logged under their path, shortened path or nickname, so each of these gets the device's level.
+        device_levels = {}
+        for device, compiled_device in devices.items():
+            for name in (device, shorten_name(device), compiled_device[device_nickname_tag]):
+                if isinstance(name, str) and name != "":
+                    device_levels[name] = compiled_device[log_level_tag]
+        self.device_levels = device_levels
+
+    def enabled(self, level, device=""):
+        # Whether a record would be written, so callers can skip building expensive messages.
+        return level >= self.level and level >= self.device_levels.get(device, log_debug)
+
+    def log(self, level, device="", current_layer="", msg="", coalesce=False):
+        if not self.enabled(level, device):
+            return
+        if not self.threaded:
+            with self.lock:
+                try:
+                    sys.stdout.write(self.format((time(), level, device, current_layer, msg, coalesce)) + "\n")
+                    sys.stdout.flush()
+                except (OSError, ValueError):
+                    pass
+            return
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = run_thread(self.write_loop, (), daemon=True)
+        try:
+            self.queue.put_nowait((time(), level, device, current_layer, msg, coalesce))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def format(self, record):
+        timestamp, level, device, current_layer, msg, coalesce = record
+        if self.json_lines:
+            return json.dumps({"time": timestamp, "level": log_level_names.get(level, level), "device": device, "layer": current_layer, "msg": msg})
+        return gen_log_msg(device, current_layer, msg)
+
+    def write_loop(self):
+        repeated = None # The last coalescing record written, and how often it repeated since.
+        repeats = 0
+        dropped = 0
+        while True:
+            try:
+                record = self.queue.get(timeout=log_coalesce_interval_def if repeated is not None else None)
+            except queue.Empty:
+                record = ()
+            lines = []
+            if repeated is not None and (record is None or len(record) == 0 or not record[5] or record[2:5] != repeated[2:5] or record[0] - repeated[0] > log_coalesce_interval_def):
+                if repeats > 0:
+                    lines.append(self.format((*repeated[:4], f"{repeated[4]} (repeated {repeats} more times)", False)))
+                repeated = None
+                repeats = 0
+            if record is None:
+                break
+            if len(record) > 0:
+                if record[5] and repeated is not None:
+                    repeats += 1
+                else:
+                    lines.append(self.format(record))
+                    if record[5]:
+                        repeated = record
+            if self.dropped != dropped:
+                lines.append(self.format((time(), log_warning, "", "", f"Dropped [ {self.dropped - dropped} ] log messages because the log queue was full.", False)))
+                dropped = self.dropped
+            if len(lines) > 0:
+                try:
+                    sys.stdout.write("\n".join(lines) + "\n")
+                    if self.queue.empty():
+                        sys.stdout.flush()
+                except (OSError, ValueError):
+                    pass
+        sys.stdout.flush()
+
+    def close(self):
+        # Writes everything still queued, then stops the writer thread.
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def set_threaded(self, threaded):
+        # Used by the supervisor, which must not run threads when it forks. Stopping the writer thread writes everything queued.
+        if not threaded:
+            self.close()
+        self.threaded = threaded
+
+    def after_fork(self):
+        # The writer thread doesn't survive fork(), and it may have held the queue's locks, so a child starts over.
+        # Forked workers go back to the writer thread, only the supervisor itself writes right away.
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.lock = Lock()
+        self.thread = None
+        self.threaded = True
+        self.dropped = 0
+
+logger = Logger()
+os.register_at_fork(after_in_child=logger.after_fork)
+
+def log(level, device="", current_layer="", msg="", coalesce=False):
+    logger.log(level, device, current_layer, msg, coalesce)
+
+
+def print_cmd_output(output, device="", current_layer=""):
+    if output != "" and output != "\n":
         if "\n" in output:
             output = "|".join(output.splitlines())
-        print(gen_log_msg(device, current_layer, f"Command output: [ {output} ]"))
+        log(log_info, device, current_layer, f"Command output: [ {output} ]")
 
-def run_thread(target, args):
-    Thread(target=target, args=args, daemon=False).start()
+async def async_exec_cmd(cmd, device="", current_layer="", print_output=True, trace=None):
+    # cmd is a shell command string, or an argv tuple to run without a shell.
+    stdout = asyncio.subprocess.PIPE if print_output else asyncio.subprocess.DEVNULL
+    if isinstance(cmd, str):
+        process = await asyncio.create_subprocess_shell(cmd, start_new_session=True, stdout=stdout)
+    else:
+        process = await asyncio.create_subprocess_exec(*cmd, start_new_session=True, stdout=stdout)
+    record_trace(trace, stage_output_tag)
+    output, errors = await process.communicate()
+    if print_output:
+        print_cmd_output(output.decode("utf-8"), device, current_layer)
 
 
-def set_key(code, state=0, dev=uinput.UInput()):
-    key = ecodes.ecodes[code]
-    dev.write(ecodes.EV_KEY, key, state)
-    dev.syn()
+class ChildProcess():
+    __slots__ = ("pid", "pidfd", "stdout", "output", "device", "current_layer", "running", "done")
 
-def press_key(code, hold_time=hold_time_def, dev=uinput.UInput()):
-    set_key(code, 1, dev)
-    sleep(hold_time)
-    set_key(code, 0, dev)
+    def __init__(self, pid, pidfd, stdout, device, current_layer, done=None):
+        self.pid = pid
+        self.pidfd = pidfd
+        self.stdout = stdout
+        self.output = []
+        self.device = device
+        self.current_layer = current_layer
+        self.running = True
+        self.done = done # Called once the child has exited and its output was printed.
 
-def press_keys(keys, dev=uinput.UInput()):
-    for key in keys:
-        if set_key_tag in key.keys():
-            set_key(key[key_tag], key[set_key_tag], dev)
+class ProcessRunner():
+    # Starts commands with posix_spawn and no shell, and reaps them (and prints their output) from one
+    # background thread, so no thread has to block waiting for a child to exit.
+    # At most queue_depth children run per device, commands past that are dropped.
+    def __init__(self, queue_depth=executor_queue_depth_def):
+        self.queue_depth = max(1, queue_depth)
+        self.lock = Lock()
+        self.selector = None
+        self.wake_read, self.wake_write = os.pipe()
+        self.new_children = []
+        self.children = {}
+        self.device_children = {} # Device -> children spawned for it that weren't reaped yet.
+        self.children_done = Condition(self.lock)
+        self.spawned = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "running": sum(self.device_children.values()),
+                "spawned": self.spawned,
+                "failed": self.failed,
+                "dropped": self.dropped
+            }
+
+    def spawn(self, argv, device="", current_layer="", print_output=True, done=None):
+        # Returns the child's pid, or None if the device already has queue_depth children running.
+        # done is called once the child has exited, or right away if it won't be started.
+        with self.lock:
+            if self.device_children.get(device, 0) >= self.queue_depth:
+                self.dropped += 1
+                dropped = True
+            else:
+                self.device_children[device] = self.device_children.get(device, 0) + 1
+                dropped = False
+        if dropped:
+            if done is not None:
+                done()
+            return None
+        try:
+            pid, pidfd, stdout = self.start_child(argv, print_output)
+        except:
+            with self.lock:
+                self.failed += 1
+                self.release(device)
+            raise
+        with self.lock:
+            self.spawned += 1
+            self.new_children.append(ChildProcess(pid, pidfd, stdout, device, current_layer, done))
+            if self.selector is None:
+                self.selector = selectors.DefaultSelector()
+                self.selector.register(self.wake_read, selectors.EVENT_READ)
+                run_thread(self.reap_loop, (), daemon=True)
+        os.write(self.wake_write, b"\0")
+        return pid
+
+    def release(self, device):
+        # Needs self.lock.
+        self.device_children[device] -= 1
+        if self.device_children[device] == 0:
+            del self.device_children[device]
+
+    def start_child(self, argv, print_output):
+        stdout = None
+        if print_output:
+            stdout, child_stdout = os.pipe()
+            file_actions = [(os.POSIX_SPAWN_DUP2, child_stdout, 1)]
         else:
-            if delay_tag in key.keys():
-                sleep(key[delay_tag])
-            press_key(key[key_tag], key.get(hold_time_tag, hold_time_def), dev)
+            file_actions = [(os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0)]
+        try:
+            pid = os.posix_spawnp(argv[0], list(argv), os.environ, file_actions=file_actions, setsid=True, setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+        except OSError:
+            if stdout is not None:
+                os.close(stdout)
+            raise
+        finally:
+            if stdout is not None:
+                os.close(child_stdout)
+        try:
+            pidfd = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            pidfd = None
+        return pid, pidfd, stdout
+
+    def finish(self, child):
+        if child.running:
+            try:
+                pid, status = os.waitpid(child.pid, os.WNOHANG)
+            except ChildProcessError:
+                pid, status = child.pid, 0
+            if pid == 0:
+                return
+            if status != 0:
+                with self.lock:
+                    self.failed += 1
+            child.running = False
+            if child.pidfd is not None:
+                self.selector.unregister(child.pidfd)
+                os.close(child.pidfd)
+        if not child.running and child.stdout is None:
+            if len(child.output) > 0:
+                print_cmd_output(b"".join(child.output).decode("utf-8", "replace"), child.device, child.current_layer)
+            if child.done is not None:
+                child.done()
+            with self.lock:
+                del self.children[child.pid]
+                self.release(child.device)
+                self.children_done.notify_all()
+
+    def reap_loop(self):
+        while True:
+            # Without pidfds, exited children can only be found by checking every so often.
+            timeout = 1.0 if any(child.pidfd is None and child.running for child in self.children.values()) else None
+            for key, events in self.selector.select(timeout):
+                if key.fd == self.wake_read:
+                    os.read(self.wake_read, 4096)
+                    with self.lock:
+                        new_children, self.new_children = self.new_children, []
+                        for child in new_children:
+                            self.children[child.pid] = child
+                    for child in new_children:
+                        if child.pidfd is not None:
+                            self.selector.register(child.pidfd, selectors.EVENT_READ, (child, True))
+                        if child.stdout is not None:
+                            self.selector.register(child.stdout, selectors.EVENT_READ, (child, False))
+                        else:
+                            self.finish(child)
+                else:
+                    child, is_pidfd = key.data
+                    if is_pidfd:
+                        # The same select() may report the pipe closing first, which already reaped the child.
+                        if child.running:
+                            self.finish(child)
+                    else:
+                        data = os.read(child.stdout, 64 * 1024)
+                        if len(data) > 0:
+                            child.output.append(data)
+                        else:
+                            self.selector.unregister(child.stdout)
+                            os.close(child.stdout)
+                            child.stdout = None
+                            self.finish(child)
+            if timeout is not None:
+                for child in list(self.children.values()):
+                    if child.running and child.pidfd is None:
+                        self.finish(child)
+
+    def wait(self):
+        # Blocks until every started child has exited and its output was printed.
+        with self.lock:
+            while len(self.children) > 0 or len(self.new_children) > 0:
+                self.children_done.wait()
+
+def run_thread(target, args, daemon=False):
+    thread = Thread(target=target, args=args, daemon=daemon)
+    thread.start()
+    return thread
+
+
+class Histogram():
+    # Latency histogram with power of two buckets, bucket i counts latencies under 2**i microseconds.
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets = [0] * 32
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        seconds = max(0.0, seconds)
+        self.buckets[min(int(seconds * 1000000).bit_length(), len(self.buckets) - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, buckets, count, total, maximum):
+        for index, bucket_count in enumerate(buckets):
+            self.buckets[index] += bucket_count
+        self.count += count
+        self.total += total
+        self.max = max(self.max, maximum)
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the percentile, in milliseconds.
+        needed = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count > 0 and seen >= needed:
+                if index == len(self.buckets) - 1:
+                    break
+                return min((2 ** index) / 1000, self.max * 1000)
+        return self.max * 1000
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total * 1000 / self.count, 3) if self.count > 0 else 0.0,
+            "p50_ms": round(self.percentile(0.5), 3),
+            "p90_ms": round(self.percentile(0.9), 3),
+            "p99_ms": round(self.percentile(0.99), 3),
+            "max_ms": round(self.max * 1000, 3),
+            "buckets_us": {str(2 ** index): count for index, count in enumerate(self.buckets) if count > 0}
+        }
+
+class LatencyStats():
+    # Per-device, per-layer and per-action-type latency histograms for the stages of handling a key press:
+    #     queue: kernel event timestamp -> event read by keysboard
+    #     resolve: event read -> keybind looked up
+    #     action_start: kernel event timestamp -> action started
+    #     output: kernel event timestamp -> first uinput write or process spawned
+    # Only created when stats are enabled, dispatch skips all of this otherwise.
+    def __init__(self, stats_file=stats_file_def, interval=stats_interval_def):
+        self.stats_file = stats_file
+        self.interval = interval
+        self.lock = Lock()
+        self.histograms = {stats_devices_tag: {}, stats_layers_tag: {}, stats_actions_tag: {}}
+        self.counters = {} # Name -> function returning a dict of extra counters for the dump.
+        self.sources = {} # Source -> latest dump_raw() of another process (supervised workers), merged into dump().
+        self.send = None # When set, write() passes dump_raw() to it instead of writing the stats file.
+
+    def record(self, device, layer, action_type, stage, seconds):
+        with self.lock:
+            for scope, name in ((stats_devices_tag, device), (stats_layers_tag, f"{device} / {layer}"), (stats_actions_tag, action_type)):
+                if name is not None:
+                    self.histograms[scope].setdefault(name, {}).setdefault(stage, Histogram()).add(seconds)
+
+    def raw_histograms(self):
+        # Plain lists instead of summaries, so histograms from several processes can be merged exactly. Needs self.lock.
+        return {scope: {name: {stage: [histogram.buckets, histogram.count, histogram.total, histogram.max] for stage, histogram in stages.items()} for name, stages in names.items()} for scope, names in self.histograms.items()}
+
+    def dump_raw(self):
+        with self.lock:
+            histograms = self.raw_histograms()
+        return {stats_histograms_tag: histograms, stats_counters_tag: {name: counters() for name, counters in self.counters.items()}}
+
+    def set_source(self, source, raw):
+        with self.lock:
+            self.sources[source] = raw
+
+    def dump(self):
+        with self.lock:
+            histograms = self.histograms
+            if len(self.sources) > 0:
+                histograms = {scope: {} for scope in self.histograms}
+                for source_histograms in [self.raw_histograms()] + [raw[stats_histograms_tag] for raw in self.sources.values()]:
+                    for scope, names in source_histograms.items():
+                        for name, stages in names.items():
+                            for stage, values in stages.items():
+                                histograms[scope].setdefault(name, {}).setdefault(stage, Histogram()).merge(*values)
+            stats = {scope: {name: {stage: histogram.summary() for stage, histogram in stages.items()} for name, stages in names.items()} for scope, names in histograms.items()}
+            sources = list(self.sources.values())
+        for name, counters in self.counters.items():
+            stats[name] = counters()
+        for raw in sources:
+            # Counters of the same name from several processes are added up.
+            for name, counters in raw[stats_counters_tag].items():
+                merged = stats.setdefault(name, {})
+                for counter, value in counters.items():
+                    merged[counter] = merged.get(counter, 0) + value
+        stats["time"] = time()
+        return stats
+
+    def write(self):
+        if self.send is not None:
+            self.send(self.dump_raw())
+            return
+        try:
+            save_config(self.dump(), self.stats_file)
+        except OSError as error:
+            log(log_warning, msg=f"Could not write latency stats to [ {self.stats_file} ]: {str(error)}")
+
+    def write_loop(self):
+        while True:
+            sleep(self.interval)
+            self.write()
+
+    def start(self):
+        # Writes the stats file every interval, and right away on SIGUSR1.
+        try:
+            signal.signal(signal.SIGUSR1, lambda signum, frame: run_thread(self.write, (), daemon=True))
+        except ValueError:
+            pass
+        run_thread(self.write_loop, (), daemon=True)
+
+def record_trace(trace, stage):
+    # trace is (stats, device, layer, action_type, origin) where origin is the monotonic time of the kernel event.
+    if trace is not None:
+        stats, device, layer, action_type, origin = trace
+        stats.record(device, layer, action_type, stage, monotonic() - origin)
+
+def print_stats(stats_file):
+    with open(stats_file) as f:
+        print_stats_dump(json.load(f))
+
+def print_stats_dump(stats):
+    for scope in (stats_devices_tag, stats_layers_tag, stats_actions_tag):
+        for name, stages in stats.get(scope, {}).items():
+            for stage in (stage_queue_tag, stage_resolve_tag, stage_action_start_tag, stage_output_tag):
+                if stage in stages:
+                    summary = stages[stage]
+                    print(f"[ {scope} ] [ {name} ] {stage}: count {summary['count']}, mean {summary['mean_ms']} ms, p50 {summary['p50_ms']} ms, p90 {summary['p90_ms']} ms, p99 {summary['p99_ms']} ms, max {summary['max_ms']} ms")
+    for name, counters in stats.items():
+        if isinstance(counters, dict) and name not in (stats_devices_tag, stats_layers_tag, stats_actions_tag):
+            print(f"[ {name} ] " + ", ".join(f"{counter}: {value}" for counter, value in counters.items()))
+
+
+# evdev (and asyncio) are imported by import_evdev() only when devices are run, so config editing commands start fast.
+InputDevice = None
+UInput = None
+ecodes = None
+asyncio = None
+
+def import_evdev():
+    global InputDevice, UInput, ecodes, asyncio
+    import asyncio
+    from evdev import InputDevice, UInput, ecodes
+
+class LazyUInput():
+    # A virtual output device that is only created once a keyboard action first writes to it.
+    def __init__(self):
+        self.dev = None
+        self.lock = Lock()
+
+    def get(self):
+        if self.dev is None:
+            with self.lock:
+                if self.dev is None:
+                    self.dev = UInput()
+        return self.dev
+
+    def write(self, event_type, code, value):
+        self.get().write(event_type, code, value)
+
+    def syn(self):
+        self.get().syn()
+
+    def close(self):
+        if self.dev is not None:
+            self.dev.close()
+            self.dev = None
+
+def set_keys(events, dev):
+    # Writes simultaneous (code, state) key changes as one SYN report.
+    for code, state in events:
+        dev.write(ecodes.EV_KEY, code, state)
+    dev.syn()
+
+
+class KeyPlayback():
+    __slots__ = ("output", "frames", "index", "start", "timeline", "sequence", "trace", "done")
+
+    def __init__(self, output, timeline, start, sequence, trace=None, done=None):
+        self.trace = trace
+        self.done = done # Called once the last frame was played.
+        self.output = output
+        self.timeline = timeline
+        self.frames = timeline[1]
+        self.index = 0
+        self.start = start
+        self.sequence = sequence # Breaks deadline ties in the order actions were queued.
+
+class KeyScheduler():
+    # Plays compiled keyboard timelines for every device from one thread, off a heap of monotonic deadlines.
+    # Each frame of simultaneous key changes is written as one SYN report, and actions sent to the same
+    # output device play one after another, never interleaved.
+    def __init__(self, queue_depth=executor_queue_depth_def, full_policy=executor_full_policy_def):
+        self.queue_depth = max(1, queue_depth)
+        self.full_policy = full_policy
+        self.condition = Condition()
+        self.heap = []
+        self.sequence = 0
+        self.lane_ends = {} # Output -> monotonic time its last queued action finishes.
+        self.lane_playbacks = {} # Output -> unfinished playbacks, oldest first.
+        self.thread = None
+        self.played = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def stats(self):
+        with self.condition:
+            return {
+                "queued": sum(len(playbacks) for playbacks in self.lane_playbacks.values()),
+                "running": sum(1 for playbacks in self.lane_playbacks.values() if len(playbacks) > 0 and playbacks[0].index > 0),
+                "played": self.played,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced
+            }
+
+    def push(self, playback):
+        heapq.heappush(self.heap, (playback.start + playback.frames[playback.index][0], playback.sequence, playback))
+
+    def play(self, output, timeline, trace=None, done=None):
+        # timeline is a compiled (duration, frames) keyboard action. Returns False if it was dropped.
+        # done is called once it has played, or right away if it won't be.
+        duration, frames = timeline
+        with self.condition:
+            playbacks = self.lane_playbacks.setdefault(output, deque())
+            start = None
+            if len(playbacks) >= self.queue_depth:
+                if self.full_policy == full_policy_coalesce_tag and playbacks[-1].index == 0:
+                    # Last wins: the newest waiting action is replaced, taking its place in the lane.
+                    replaced = playbacks.pop()
+                    self.heap.remove((replaced.start + replaced.frames[0][0], replaced.sequence, replaced))
+                    heapq.heapify(self.heap)
+                    start = replaced.start
+                    self.coalesced += 1
+                    if replaced.done is not None:
+                        replaced.done()
+                else:
+                    self.dropped += 1
+                    if done is not None:
+                        done()
+                    return False
+            if start is None:
+                start = max(monotonic(), self.lane_ends.get(output, 0.0))
+            self.lane_ends[output] = start + duration
+            if len(frames) == 0:
+                if done is not None:
+                    done()
+                return True
+            playback = KeyPlayback(output, timeline, start, self.sequence, trace, done)
+            self.sequence += 1
+            playbacks.append(playback)
+            self.push(playback)
+            if self.thread is None:
+                self.thread = run_thread(self.play_loop, (), daemon=True)
+            self.condition.notify()
+            return True
+
+    def play_loop(self):
+        while True:
+            with self.condition:
+                while True:
+                    if len(self.heap) == 0:
+                        self.condition.wait()
+                        continue
+                    deadline, sequence, playback = self.heap[0]
+                    delay = deadline - monotonic()
+                    if delay > 0:
+                        self.condition.wait(delay)
+                        continue
+                    break
+                heapq.heappop(self.heap)
+                first = playback.index == 0
+                events = playback.frames[playback.index][1]
+                # Counts as playing from here on, so coalescing leaves it alone while it is written.
+                playback.index += 1
+            # Written without the lock, a write can block (the first one creates the uinput device)
+            # and threads queueing actions or reading stats mustn't wait for it.
+            try:
+                set_keys(events, playback.output)
+                if first:
+                    record_trace(playback.trace, stage_output_tag)
+            except Exception as error:
+                log(log_error, msg=f"Hit an error while simulating keys, dropping the action...: {str(error)}")
+                playback.index = len(playback.frames)
+            with self.condition:
+                if playback.index < len(playback.frames):
+                    self.push(playback)
+                else:
+                    self.lane_playbacks[playback.output].remove(playback)
+                    self.played += 1
+                    if playback.done is not None:
+                        playback.done()
+                    self.condition.notify_all()
+
+    def wait(self, output=None):
+        # Blocks until every queued action (for one output, or for all of them) has played.
+        with self.condition:
+            while any(len(playbacks) > 0 for lane, playbacks in self.lane_playbacks.items() if output is None or lane is output):
+                self.condition.wait()
+            if output is not None:
+                self.lane_playbacks.pop(output, None)
+                self.lane_ends.pop(output, None)
+
+def get_key_scheduler(config):
+    executor_config = config.get(executor_tag, {})
+    if not isinstance(executor_config, dict):
+        executor_config = {}
+    full_policy = executor_config.get(full_policy_tag, executor_full_policy_def)
+    if full_policy not in (full_policy_drop_tag, full_policy_coalesce_tag):
+        log(log_warning, msg=f"Executor full policy [ {full_policy} ] is unknown, using [ {executor_full_policy_def} ]...")
+        full_policy = executor_full_policy_def
+    if workers_tag in executor_config:
+        log(log_warning, msg=f"Executor [ {workers_tag} ] is deprecated and ignored, keyboard actions play on one scheduler thread and commands run without threads.")
+    queue_depth = executor_config.get(queue_depth_tag, executor_queue_depth_def)
+    try:
+        queue_depth = int(queue_depth)
+    except (TypeError, ValueError):
+        pass
+    if isinstance(queue_depth, bool) or not isinstance(queue_depth, int) or queue_depth < 1:
+        log(log_warning, msg=f"Executor queue depth [ {queue_depth} ] is not a positive whole number, using [ {executor_queue_depth_def} ]...")
+        queue_depth = executor_queue_depth_def
+    return KeyScheduler(queue_depth, full_policy)
+
+async def async_play_keys(timeline, dev, start, previous_task=None, trace=None):
+    # Like KeyScheduler, but on the event loop. start is the loop time the previous action on the same
+    # device finishes, which is awaited first so frames due at the same time keep their order.
+    loop = asyncio.get_running_loop()
+    if previous_task is not None and not previous_task.done():
+        await asyncio.wait((previous_task,))
+    for offset, events in timeline[1]:
+        delay = start + offset - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        set_keys(events, dev)
+        if trace is not None:
+            record_trace(trace, stage_output_tag)
+            trace = None
+
+
+# Recorded macros are stored as a header followed by three arrays of the same length, little endian:
+# key codes (uint16), states (uint8, 1 pressed or 0 released) and microseconds since the previous event (uint32).
+macro_magic = b"KBMR"
+macro_version = 1
+macro_header = struct.Struct("<4sHI") # magic, version, event count
+macro_cache = {} # Macro file -> (stat key, (codes, states, delays), {speed: timeline})
+
+def write_macro(macro_file, codes, states, delays):
+    arrays = [array(typecode, values) for typecode, values in (("H", codes), ("B", states), ("I", delays))]
+    if sys.byteorder == "big":
+        for values in arrays:
+            values.byteswap()
+    macro_dir = os.path.dirname(os.path.abspath(macro_file))
+    mkdir_p(macro_dir)
+    fd, temp_file = tempfile.mkstemp(prefix=".keysboard-", suffix=".macro", dir=macro_dir)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(macro_header.pack(macro_magic, macro_version, len(codes)))
+            for values in arrays:
+                f.write(values.tobytes())
+        os.replace(temp_file, macro_file)
+    except:
+        try:
+            os.remove(temp_file)
+        except OSError:
+            pass
+        raise
+
+def read_macro(macro_file):
+    # Returns (codes, states, delays) arrays, raising ValueError if the file isn't a recorded macro.
+    with open(macro_file, "rb") as f:
+        data = f.read()
+    if len(data) < macro_header.size:
+        raise ValueError("not a recorded macro")
+    magic, version, count = macro_header.unpack_from(data)
+    if magic != macro_magic or version != macro_version:
+        raise ValueError("not a recorded macro, or recorded by another version")
+    arrays = []
+    offset = macro_header.size
+    for typecode in ("H", "B", "I"):
+        values = array(typecode)
+        size = count * values.itemsize
+        if offset + size > len(data):
+            raise ValueError("recorded macro is truncated")
+        values.frombytes(data[offset:offset + size])
+        if sys.byteorder == "big":
+            values.byteswap()
+        arrays.append(values)
+        offset += size
+    return tuple(arrays)
+
+class MacroFrames():
+    # The frames of a recorded macro's timeline, read straight from its arrays so macros of thousands of
+    # events stay small in memory. Like compiled keyboard actions, frames[i] is (offset, ((code, state), ...)).
+    __slots__ = ("offsets", "starts", "codes", "states")
+
+    def __init__(self, offsets, starts, codes, states):
+        self.offsets = offsets # Seconds from the start of the macro, one per frame.
+        self.starts = starts # Index of each frame's first event, plus the event count.
+        self.codes = codes
+        self.states = states
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        start = self.starts[index]
+        end = self.starts[index + 1]
+        return (self.offsets[index], tuple(zip(self.codes[start:end], self.states[start:end])))
+
+def get_macro_timeline(macro_file, speed=1.0):
+    # Returns the recorded macro as a (duration, frames) keyboard timeline played faster by speed, loading
+    # it on first use and again only when the file changes. Events recorded together share one frame.
+    stat_key = config_stat_key(macro_file)
+    cached = macro_cache.get(macro_file, None)
+    if cached is None or cached[0] != stat_key:
+        cached = (stat_key, read_macro(macro_file), {})
+        macro_cache[macro_file] = cached
+    timeline = cached[2].get(speed, None)
+    if timeline is None:
+        codes, states, delays = cached[1]
+        offsets = array("d")
+        starts = array("I")
+        elapsed = 0
+        for index, delay in enumerate(delays):
+            elapsed += delay
+            if index == 0 or delay > 0:
+                # Offsets come from the total of all delays so far, so long macros don't drift.
+                offsets.append(elapsed / 1000000 / speed)
+                starts.append(index)
+        starts.append(len(codes))
+        timeline = cached[2][speed] = (offsets[-1] if len(offsets) > 0 else 0.0, MacroFrames(offsets, starts, codes, states))
+    return timeline
+
+def record_macro(device, macro_file, stop_key=record_stop_key_def):
+    # Grabs the device and records its key presses and releases until stop_key is pressed, returning the number of events.
+    import_evdev()
+    stop_code = get_key_code(stop_key)
+    dev = InputDevice(device)
+    dev.grab()
+    try:
+        import fcntl
+        # EVIOCSCLOCKID, so event times come from the monotonic clock instead of the wall clock.
+        fcntl.ioctl(dev.fd, 0x400445a0, struct.pack("i", 1))
+    except (ImportError, OSError):
+        pass
+    codes = array("H")
+    states = array("B")
+    delays = array("I")
+    pressed = set()
+    last = None
+    try:
+        for event in dev.read_loop():
+            if event.type != ecodes.EV_KEY or event.value == 2:
+                continue
+            if event.code == stop_code:
+                if event.value == 1:
+                    break
+                continue
+            if event.value == 0 and event.code not in pressed:
+                continue # Released from before the recording started.
+            now = event.sec * 1000000 + event.usec
+            delays.append(min(max(0, now - last), 0xffffffff) if last is not None else 0)
+            last = now
+            codes.append(event.code)
+            states.append(event.value)
+            if event.value == 1:
+                pressed.add(event.code)
+            else:
+                pressed.discard(event.code)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        release_device(dev)
+    for code in sorted(pressed):
+        # Never leave keys held down at the end of a replay.
+        codes.append(code)
+        states.append(0)
+        delays.append(0)
+    write_macro(macro_file, codes, states, delays)
+    return len(codes)
 
 
 def blank_layer():
@@ -178,11 +1040,25 @@ def open_config(overwrite, config_file):
     return open(config_file, "r+")
 
 def save_config(config, config_file):
+    # Writes a temporary file next to the config and renames it over the old one,
+    # so readers only ever see the complete old or the complete new config.
+    config_dir = os.path.dirname(os.path.abspath(config_file))
+    mkdir_p(config_dir)
+    fd, temp_file = tempfile.mkstemp(prefix=".keysboard-", suffix=".json", dir=config_dir)
     try:
-        f = open_config(True, config_file)
-        json.dump(config, f, indent=indent_amount)
-    finally:
-        f.close()
+        with os.fdopen(fd, "w") as f:
+            json.dump(config, f, indent=indent_amount)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.isfile(config_file):
+            os.chmod(temp_file, os.stat(config_file).st_mode & 0o7777)
+        os.replace(temp_file, config_file)
+    except:
+        try:
+            os.remove(temp_file)
+        except OSError:
+            pass
+        raise
 
 def read_config(config_file):
     f = open_config(False, config_file)
@@ -204,44 +1080,601 @@ def read_config(config_file):
         f.close()
 
 
-def add_device(device, config_file):
-    config = read_config(config_file)
+# Linux inotify(7) through libc, so file watching needs no extra dependencies.
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+inotify_event_header = struct.Struct("iIII")
 
-    if devices_tag not in config.keys():
-        config[devices_tag] = {}
-        save_config(config, config_file)
+class Inotify():
+    def __init__(self):
+        import ctypes, ctypes.util
+        self.get_errno = ctypes.get_errno
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(self.get_errno(), "inotify_init1 failed")
+        self.watches = {}
 
-    if config.get(devices_tag, {}).get(device, {}) == {}:
-        config[devices_tag][device] = blank_device()
-        save_config(config, config_file)
-    return config
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(self.get_errno(), f"inotify_add_watch failed for [ {path} ]")
+        self.watches[wd] = path
+        return wd
 
-def add_layer(device, layer, config_file):
-    config = add_device(device, config_file)
+    def read_events(self):
+        # Blocks until at least one event is available, yields (watched_path, mask, name).
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = inotify_event_header.unpack_from(data, offset)
+            offset += inotify_event_header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            yield self.watches.get(wd, ""), mask, name
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ConfigError(Exception):
+    pass
+
+def get_key_code(name):
+    code = ecodes.ecodes.get(name, None) if isinstance(name, str) else None
+    if isinstance(code, int):
+        return code
+    return None
+
+def get_inherited_layers(layer_config):
+    inherited_layers = layer_config.get(inherit_tag, [])
+    if isinstance(inherited_layers, str):
+        return [inherited_layers]
+    if isinstance(inherited_layers, list):
+        return [inherited_layer for inherited_layer in inherited_layers if isinstance(inherited_layer, str)]
+    return []
+
+def get_seconds(value, name, where):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+        raise ConfigError(f"{where}: [ {name} ] must be a non-negative number of seconds, got [ {value} ]")
+    return float(value)
+
+def compile_keyboard_action(action, bind, where):
+    # Validates key simulation parameters once and lays them out on a timeline, returning
+    # (duration, frames) where frames are (offset, ((code, state), ...)) key changes that happen together.
+    if isinstance(action, list):
+        keys = action
+    elif isinstance(action, dict):
+        # Single keys historically took set_key/hold_time from the bind itself, so fall back to it.
+        keys = [{**{tag: bind[tag] for tag in (set_key_tag, hold_time_tag) if tag in bind}, **action}]
+    else:
+        raise ConfigError(f"{where}: keyboard action [ {action} ] is not a key or a list of keys")
+    frames = {}
+    offset = 0.0
+    for key in keys:
+        if not isinstance(key, dict) or key_tag not in key:
+            raise ConfigError(f"{where}: keyboard action entry [ {key} ] has no [ {key_tag} ]")
+        code = get_key_code(key[key_tag])
+        if code is None:
+            raise ConfigError(f"{where}: keycode [ {key[key_tag]} ] is unknown")
+        if set_key_tag in key:
+            state = key[set_key_tag]
+            if state not in (0, 1, 2) or isinstance(state, bool):
+                raise ConfigError(f"{where}: [ {set_key_tag} ] must be 0, 1 or 2, got [ {state} ]")
+            frames.setdefault(offset, []).append((code, state))
+        else:
+            offset += get_seconds(key.get(delay_tag, 0), delay_tag, where)
+            frames.setdefault(offset, []).append((code, 1))
+            offset += get_seconds(key.get(hold_time_tag, hold_time_def), hold_time_tag, where)
+            frames.setdefault(offset, []).append((code, 0))
+    return (offset, tuple((frame_offset, tuple(events)) for frame_offset, events in frames.items()))
+
+class ActionCompiler():
+    # Compiles binds into flat, immutable plans of (action_type, value) steps where action_type is
+    # shell, keyboard, macro or set_layer. Aliases and multi-actions are expanded here, not at key press time.
+    def __init__(self, device, aliases, layers, base_dir=None):
+        self.device = device
+        self.aliases = aliases if isinstance(aliases, dict) else {}
+        self.layers = layers
+        self.base_dir = base_dir # Relative macro files are found here, normally the config's directory.
+        self.alias_plans = {}
+        self.warnings = [] # (device, layer, msg), kept with the compiled device instead of logged right away.
+
+    def warn(self, device="", current_layer="", msg=""):
+        self.warnings.append((device, current_layer, msg))
+
+    def compile(self, bind, layer, key):
+        return tuple(self.compile_steps(bind, f"Device [ {self.device} ] / Layer [ {layer} ] / Key [ {key} ]", []))
+
+    def compile_steps(self, bind, where, alias_chain):
+        if not isinstance(bind, dict) or action_tag not in bind:
+            return []
+        action = bind[action_tag]
+        action_type = bind.get(action_type_tag, "")
+        if action_type == action_shell_tag or action_type == "":
+            return [(action_shell_tag, str(action))]
+        elif action_type == action_exec_tag:
+            try:
+                argv = shlex.split(action) if isinstance(action, str) else action
+            except ValueError as error:
+                raise ConfigError(f"{where}: exec action [ {action} ] is not a valid command line: {str(error)}")
+            if not isinstance(argv, list) or len(argv) == 0 or not all(isinstance(arg, str) for arg in argv):
+                raise ConfigError(f"{where}: exec action [ {action} ] is not a command line or a non-empty list of arguments")
+            return [(action_exec_tag, tuple(argv))]
+        elif action_type == action_keyboard_tag:
+            return [(action_keyboard_tag, compile_keyboard_action(action, bind, where))]
+        elif action_type == action_macro_tag:
+            if not isinstance(action, str) or action == "":
+                raise ConfigError(f"{where}: macro action [ {action} ] is not a path to a recorded macro")
+            speed = bind.get(speed_tag, 1.0)
+            if isinstance(speed, bool) or not isinstance(speed, (int, float)) or speed <= 0:
+                raise ConfigError(f"{where}: [ {speed_tag} ] must be a positive number, got [ {speed} ]")
+            macro_file = os.path.join(self.base_dir or os.getcwd(), os.path.expanduser(action))
+            # The file itself is only read on first use, so it can be recorded after the bind is added.
+            return [(action_macro_tag, (os.path.abspath(macro_file), float(speed)))]
+        elif action_type == action_set_layer_tag:
+            if not isinstance(action, str):
+                raise ConfigError(f"{where}: set_layer action [ {action} ] is not a layer name")
+            if action in self.layers:
+                return [(action_set_layer_tag, action)]
+            self.warn(msg=f"{where}: layer [ {action} ] is not in config, ignoring...")
+        elif action_type == action_alias_tag:
+            if not isinstance(action, str):
+                raise ConfigError(f"{where}: action alias [ {action} ] is not an alias name")
+            if action in alias_chain:
+                raise ConfigError(f"{where}: action alias is recursive [ {' -> '.join(alias_chain + [action])} ]")
+            if action in self.alias_plans:
+                return list(self.alias_plans[action])
+            if action in self.aliases:
+                steps = self.compile_steps(self.aliases[action], f"{where} / Alias [ {action} ]", alias_chain + [action])
+                self.alias_plans[action] = tuple(steps)
+                return steps
+            self.warn(msg=f"{where}: action alias [ {action} ] is undefined, ignoring...")
+        elif action_type == action_multi_tag:
+            if not isinstance(action, list):
+                raise ConfigError(f"{where}: multi-action [ {action} ] is not of type list")
+            steps = []
+            for sub_action in action:
+                steps.extend(self.compile_steps(sub_action, where, alias_chain))
+            return steps
+        else:
+            self.warn(msg=f"{where}: action type [ {action_type} ] is unknown, ignoring...")
+        return []
+
+def compile_bind_options(bind, defaults, where):
+    # Returns (debounce, repeat interval, max in flight) for a bind, or None when it has none of these options,
+    # so plain binds cost nothing extra at key press time. Options the bind leaves out come from its layer's bind_defaults.
+    options = {**defaults, **{tag: bind[tag] for tag in (debounce_tag, repeat_rate_tag, max_in_flight_tag, coalesce_tag) if tag in bind}}
+    debounce = get_seconds(options.get(debounce_tag, 0), debounce_tag, where)
+    repeat_rate = options.get(repeat_rate_tag, 0)
+    if isinstance(repeat_rate, bool) or not isinstance(repeat_rate, (int, float)) or repeat_rate < 0:
+        raise ConfigError(f"{where}: [ {repeat_rate_tag} ] must be a non-negative number of repeats per second, got [ {repeat_rate} ]")
+    max_in_flight = options.get(max_in_flight_tag, 0)
+    if isinstance(max_in_flight, bool) or not isinstance(max_in_flight, int) or max_in_flight < 0:
+        raise ConfigError(f"{where}: [ {max_in_flight_tag} ] must be a non-negative whole number, got [ {max_in_flight} ]")
+    if options.get(coalesce_tag, False) is True:
+        max_in_flight = 1
+    if debounce == 0 and repeat_rate == 0 and max_in_flight == 0:
+        return None
+    return (debounce, 1.0 / repeat_rate if repeat_rate > 0 else 0.0, max_in_flight)
+
+def compile_keymaps(device, layers, action_compiler):
+    # Flattens every layer with its (transitively) inherited layers into one {key code: plan} dict.
+    # Inherited layers apply in order, later ones and the layer's own keybinds override earlier ones.
+    # Returns (keymaps, bind options) where bind options only has the layers and keys with options.
+    keymaps = {}
+    bind_options = {}
+    def resolve(layer, chain):
+        if layer in keymaps:
+            return keymaps[layer], bind_options.get(layer, {})
+        if layer in chain:
+            raise ConfigError(f"Device [ {device} ]: layer inheritance cycle [ {' -> '.join(chain + [layer])} ]")
+        keymap = {}
+        layer_options = {}
+        for inherited_layer in get_inherited_layers(layers[layer]):
+            if inherited_layer in layers:
+                inherited_keymap, inherited_options = resolve(inherited_layer, chain + [layer])
+                for code in inherited_keymap:
+                    layer_options.pop(code, None)
+                keymap.update(inherited_keymap)
+                layer_options.update(inherited_options)
+            else:
+                action_compiler.warn(device, layer, f"Inherited layer [ {inherited_layer} ] is not in config, ignoring...")
+        defaults = layers[layer].get(bind_defaults_tag, {})
+        if not isinstance(defaults, dict):
+            raise ConfigError(f"Device [ {device} ] / Layer [ {layer} ]: [ {bind_defaults_tag} ] is not an object")
+        keybinds = layers[layer].get(keybinds_tag, {})
+        if not isinstance(keybinds, dict):
+            raise ConfigError(f"Device [ {device} ] / Layer [ {layer} ]: [ {keybinds_tag} ] is not an object")
+        for key, bind in keybinds.items():
+            code = get_key_code(key)
+            if code is None:
+                action_compiler.warn(device, layer, f"Keycode [ {key} ] is unknown, ignoring...")
+            elif isinstance(bind, dict):
+                keymap[code] = action_compiler.compile(bind, layer, key)
+                options = compile_bind_options(bind, defaults, f"Device [ {device} ] / Layer [ {layer} ] / Key [ {key} ]")
+                if options is not None:
+                    layer_options[code] = options
+                else:
+                    layer_options.pop(code, None)
+        keymaps[layer] = keymap
+        if len(layer_options) > 0:
+            bind_options[layer] = layer_options
+        return keymap, layer_options
+    for layer in layers:
+        resolve(layer, [])
+    return keymaps, bind_options
+
+def get_device_log_level(device, device_config, warnings):
+    # Configs from before log_level used print_key_codes (debug) and print_actions (info), both defaulting to on.
+    if log_level_tag in device_config:
+        if isinstance(device_config[log_level_tag], str) and device_config[log_level_tag] in log_levels:
+            return log_levels[device_config[log_level_tag]]
+        warnings.append((device, "", f"Log level [ {device_config[log_level_tag]} ] is unknown, using [ {log_level_def} ]..."))
+        return log_levels[log_level_def]
+    if device_config.get(print_key_codes_tag, True):
+        return log_debug
+    if device_config.get(print_actions_tag, True):
+        return log_info
+    return log_warning
+
+def compile_device(device, device_config, base_dir=None):
+    layers = device_config.get(layers_tag, {})
+    if not isinstance(layers, dict):
+        raise ConfigError(f"Device [ {device} ]: [ {layers_tag} ] is not an object")
+    layers = {layer: layer_config for layer, layer_config in layers.items() if isinstance(layer_config, dict)}
+    exit_codes = []
+    for exit_key in (device_config.get(exit_key_tag, None), universal_exit_key):
+        code = get_key_code(exit_key)
+        if code is not None:
+            exit_codes.append(code)
+    action_compiler = ActionCompiler(device, device_config.get(aliases_tag, {}), layers, base_dir)
+    keymaps, bind_options = compile_keymaps(device, layers, action_compiler)
+    return {
+        device_nickname_tag: device_config.get(device_nickname_tag, ""),
+        device_name_tag: device_config.get(device_name_tag, None),
+        first_layer_tag: device_config.get(first_layer_tag, get_first_layer({layers_tag: layers})),
+        exit_codes_tag: frozenset(exit_codes),
+        exit_cmd_tag: device_config.get(exit_cmd_tag, None),
+        log_level_tag: get_device_log_level(device, device_config, action_compiler.warnings),
+        keymaps_tag: keymaps,
+        bind_options_tag: bind_options,
+        compile_warnings_tag: tuple(action_compiler.warnings)
+    }
+
+def compile_devices(config, base_dir=None):
+    if not isinstance(config, dict):
+        raise ConfigError("the config is not an object")
+    devices = config.get(devices_tag, {})
+    if not isinstance(devices, dict):
+        raise ConfigError(f"[ {devices_tag} ] is not an object")
+    return {device: compile_device(device, device_config, base_dir) for device, device_config in devices.items() if isinstance(device_config, dict)}
+
+
+# The compiled config cache is a header followed by marshal data of (config, compiled devices).
+# It is only used while the config's mtime and size, or failing that its hash, still match the header, and while
+# everything else that went into compiling it (see get_compiler_digest()) is unchanged.
+config_cache_magic = b"KBCC"
+config_cache_version = 5 # Bump whenever the compiled format changes.
+config_cache_header = struct.Struct("<4sIIqq20s20s") # magic, cache version, marshal version, mtime_ns, size, sha1, compiler sha1
+compiler_digest_base = None # Hash of this script, evdev's version and its key codes, they don't change while running.
+
+def get_compiler_digest(base_dir):
+    # Hashes the inputs of compile_devices() other than the config itself: this script's code, evdev's key codes,
+    # the config defaults compiled devices depend on and the directory relative macro files are found in.
+    global compiler_digest_base
+    if compiler_digest_base is None:
+        digest = hashlib.sha1()
+        try:
+            with open(os.path.abspath(__file__), "rb") as f:
+                digest.update(f.read())
+        except OSError:
+            pass
+        try:
+            from importlib.metadata import version
+            digest.update(version("evdev").encode())
+        except Exception:
+            pass
+        if ecodes is not None:
+            digest.update(repr(sorted((name, code) for name, code in ecodes.ecodes.items() if isinstance(code, int))).encode())
+        compiler_digest_base = digest
+    digest = compiler_digest_base.copy()
+    digest.update(repr((hold_time_def, universal_exit_key, log_level_def, shorten_name_amount, base_dir)).encode())
+    return digest.digest()
+
+def get_config_cache_file(config_file):
+    return config_file + ".cache"
+
+def read_config_cache(config_file, stat_key, compiler_digest, digest=None):
+    # Returns (config, devices, digest) from the cache if it matches stat_key, or digest when given, else None.
+    # The whole file is read and unmarshalled, which is still much faster than parsing and compiling the JSON.
+    try:
+        with open(get_config_cache_file(config_file), "rb") as f:
+            data = f.read()
+        magic, version, marshal_version, mtime_ns, size, cached_digest, cached_compiler_digest = config_cache_header.unpack_from(data)
+        if magic != config_cache_magic or version != config_cache_version or marshal_version != marshal.version or cached_compiler_digest != compiler_digest:
+            return None
+        if digest is None and (size, mtime_ns) != stat_key[1:]:
+            return None
+        if digest is not None and digest != cached_digest:
+            return None
+        config, devices = marshal.loads(memoryview(data)[config_cache_header.size:])
+        return config, devices, cached_digest
+    except (OSError, ValueError, EOFError, TypeError, struct.error):
+        return None
+
+def write_config_cache(config_file, stat_key, digest, compiler_digest, config, devices):
+    cache_file = get_config_cache_file(config_file)
+    try:
+        data = config_cache_header.pack(config_cache_magic, config_cache_version, marshal.version, stat_key[2], stat_key[1], digest, compiler_digest) + marshal.dumps((config, devices))
+        fd, temp_file = tempfile.mkstemp(prefix=".keysboard-", suffix=".cache", dir=os.path.dirname(os.path.abspath(cache_file)))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_file, cache_file)
+    except (OSError, ValueError) as error:
+        log(log_warning, msg=f"Could not write the config cache [ {cache_file} ]: {str(error)}")
+
+
+class ConfigSnapshot():
+    # One parsed config plus its compiled devices, shared read-only by every device thread. Never mutated, only replaced.
+    __slots__ = ("config", "devices", "stat_key", "digest")
+
+    def __init__(self, config, devices, stat_key, digest):
+        self.config = config
+        self.devices = devices
+        self.stat_key = stat_key
+        self.digest = digest
+
+def config_stat_key(config_file):
+    st = os.stat(config_file)
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+class ConfigManager():
+    def __init__(self, config_file=None):
+        self.config_file = config_file
+        self.base_dir = os.path.dirname(os.path.abspath(config_file)) if config_file is not None else None
+        self.snapshot = None
+        self.lock = Lock()
+
+    def get(self):
+        return self.snapshot
+
+    def set_snapshot(self, snapshot):
+        # Swaps in a snapshot with newly compiled devices, logging their compile warnings whether they
+        # were just compiled or loaded from the cache. Needs self.lock.
+        logger.set_device_levels(snapshot.devices)
+        for compiled_device in snapshot.devices.values():
+            for device, current_layer, msg in compiled_device[compile_warnings_tag]:
+                log(log_warning, device, current_layer, msg)
+        self.snapshot = snapshot
+
+    def set_config(self, config):
+        # Compiles and swaps in a config that didn't come from the file, raising ConfigError if it is invalid.
+        devices = compile_devices(config, self.base_dir)
+        with self.lock:
+            self.set_snapshot(ConfigSnapshot(config, devices, None, None))
+        return self.snapshot
+
+    def edit(self, edit):
+        # Applies edit(config) to a copy of the current config and swaps it in without touching the file,
+        # raising ConfigError if the result is invalid. edit returns whether it changed anything.
+        # The edited config lasts until the file itself changes or is reloaded.
+        with self.lock:
+            snapshot = self.snapshot
+            config = copy.deepcopy(snapshot.config)
+            if edit(config):
+                self.set_snapshot(ConfigSnapshot(config, compile_devices(config, self.base_dir), snapshot.stat_key, snapshot.digest))
+            return self.snapshot
+
+    def load(self):
+        if not self.reload():
+            # Let read_config create a missing config or back up a broken one, as before.
+            read_config(self.config_file)
+            if not self.reload():
+                raise ConfigError(f"Config [ {self.config_file} ] could not be loaded")
+        return self.snapshot
+
+    def reload(self, force=False):
+        # Swaps in a new snapshot if the file really changed, or always with force. A broken edit keeps the last good snapshot.
+        with self.lock:
+            keeping = ", keeping the current one" if self.snapshot is not None else ""
+            current = None if force else self.snapshot
+            try:
+                stat_key = config_stat_key(self.config_file)
+                if current is not None and stat_key == current.stat_key:
+                    return False
+                compiler_digest = get_compiler_digest(self.base_dir) if config_cache_def else None
+                cached = read_config_cache(self.config_file, stat_key, compiler_digest) if config_cache_def else None
+                if cached is None:
+                    with open(self.config_file, "rb") as f:
+                        raw = f.read()
+            except OSError as error:
+                log(log_warning, msg=f"Could not read config [ {self.config_file} ]{keeping}: {str(error)}")
+                return False
+            if cached is None:
+                digest = hashlib.sha1(raw).digest()
+                if current is not None and digest == current.digest:
+                    self.snapshot = ConfigSnapshot(current.config, current.devices, stat_key, digest)
+                    return False
+                # The file may only have been touched, so the cache can still match by hash.
+                cached = read_config_cache(self.config_file, stat_key, compiler_digest, digest) if config_cache_def else None
+                if cached is None:
+                    try:
+                        config = json.loads(raw)
+                        devices = compile_devices(config, self.base_dir)
+                    except (JSONDecodeError, UnicodeDecodeError, ConfigError) as error:
+                        log(log_error, msg=f"Config [ {self.config_file} ] is invalid{keeping}: {str(error)}")
+                        return False
+                    cached = (config, devices, digest)
+                if config_cache_def:
+                    write_config_cache(self.config_file, stat_key, cached[2], compiler_digest, cached[0], cached[1])
+            config, devices, digest = cached
+            if current is not None and digest == current.digest:
+                self.snapshot = ConfigSnapshot(current.config, current.devices, stat_key, digest)
+                return False
+            self.set_snapshot(ConfigSnapshot(config, devices, stat_key, digest))
+            return True
+
+    def watch(self):
+        run_thread(self.watch_loop, (), daemon=True)
+
+    def watch_reload(self):
+        # Errors the compiler didn't anticipate must not end the watcher, the next edit may well fix them.
+        try:
+            if self.reload():
+                log(log_info, msg="Config reloaded.")
+        except Exception as error:
+            log(log_error, msg=f"Hit an error while reloading config [ {self.config_file} ], keeping the current one: {str(error)}")
+
+    def watch_loop(self):
+        config_dir = os.path.dirname(os.path.abspath(self.config_file))
+        config_name = os.path.basename(self.config_file)
+        try:
+            inotify = Inotify()
+            # Watch the directory, editors often save by writing a new file and renaming it over the old one.
+            inotify.add_watch(config_dir, IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        except (OSError, AttributeError) as error:
+            log(log_warning, msg=f"Inotify is unavailable, checking the config every {config_poll_interval_def} seconds instead: {str(error)}")
+            while True:
+                sleep(config_poll_interval_def)
+                self.watch_reload()
+        while True:
+            changed = False
+            for path, mask, name in inotify.read_events():
+                if name == config_name or mask & IN_Q_OVERFLOW:
+                    changed = True
+            if changed:
+                self.watch_reload()
+
+
+class ConfigTransaction():
+    # Applies any number of edits to one in-memory copy of the config and saves it once, atomically, on exit:
+    #     with ConfigTransaction(config_file) as transaction:
+    #         transaction.add_keybind(device, layer, key, action_type, action)
+    # Given a config and no config_file, edits that config in place and saves nothing.
+    def __init__(self, config_file, config=None):
+        self.config_file = config_file
+        self.config = config
+        self.changed = False
+
+    def __enter__(self):
+        if self.config is None:
+            self.config = read_config(self.config_file)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self.changed and self.config_file is not None:
+            save_config(self.config, self.config_file)
+        return False
 
-    if layers_tag not in config[devices_tag][device].keys():
-        config[devices_tag][device][layers_tag] = {}
-        save_config(config, config_file)
+    def add_device(self, device, template=None):
+        devices = self.config.get(devices_tag, None)
+        if not isinstance(devices, dict):
+            devices = self.config[devices_tag] = {}
+            self.changed = True
+        if devices.get(device, {}) == {}:
+            devices[device] = blank_device() if template is None else template
+            self.changed = True
+        return devices[device]
 
-    if config.get(devices_tag, {}).get(device, {}).get(layers_tag, {}).get(layer, {}) == {}:
-        config[devices_tag][device][layers_tag][layer] = blank_layer()
-        save_config(config, config_file)
-    return config
+    def add_layer(self, device, layer, template=None):
+        device_config = self.add_device(device)
+        layers = device_config.get(layers_tag, None)
+        if not isinstance(layers, dict):
+            layers = device_config[layers_tag] = {}
+            self.changed = True
+        if layers.get(layer, {}) == {}:
+            layers[layer] = blank_layer() if template is None else template
+            self.changed = True
+        return layers[layer]
+
+    def add_keybind(self, device, layer, key, action_type, action, replace=False, layer_template=None):
+        layer_config = self.add_layer(device, layer, layer_template)
+        keybinds = layer_config.get(keybinds_tag, None)
+        if not isinstance(keybinds, dict):
+            keybinds = layer_config[keybinds_tag] = {}
+            self.changed = True
+        if replace or keybinds.get(key, {}) == {}:
+            keybinds[key] = {
+                action_type_tag: action_type,
+                action_tag: action
+            }
+            self.changed = True
+        return keybinds[key]
+
+    def remove_keybind(self, device, layer, key):
+        # Returns whether there was a keybind to remove.
+        try:
+            keybinds = self.config[devices_tag][device][layers_tag][layer][keybinds_tag]
+        except (KeyError, TypeError):
+            return False
+        if not isinstance(keybinds, dict) or key not in keybinds:
+            return False
+        del keybinds[key]
+        self.changed = True
+        return True
+
+
+def add_device(device, config_file):
+    with ConfigTransaction(config_file) as transaction:
+        transaction.add_device(device)
+    return transaction.config
+
+def add_layer(device, layer, config_file):
+    with ConfigTransaction(config_file) as transaction:
+        transaction.add_layer(device, layer)
+    return transaction.config
 
 def add_keybind(device, layer, key, action_type, action, config_file):
-    config = add_layer(device, layer, config_file)
+    with ConfigTransaction(config_file) as transaction:
+        transaction.add_keybind(device, layer, key, action_type, action)
+    return transaction.config
 
-    if keybinds_tag not in config[devices_tag][device][layers_tag][layer].keys():
-        config[devices_tag][device][layers_tag][layer][keybinds_tag] = {}
-        save_config(config, config_file)
+def remove_keybind(device, layer, key, config_file):
+    with ConfigTransaction(config_file) as transaction:
+        transaction.remove_keybind(device, layer, key)
+    return transaction.config
 
-    if config.get(devices_tag, {}).get(device, {}).get(layers_tag, {}).get(layer, {}).get(keybinds_tag, {}).get(key, {}) == {}:
-        config[devices_tag][device][layers_tag][layer][keybinds_tag][key] = {
-            action_type_tag: action_type,
-            action_tag: action
-        }
-        save_config(config, config_file)
-    return config
+def read_keybinds(keybinds_file):
+    # Reads keybinds to import from a JSON list of objects or a CSV file with a header row,
+    # both using the fields device, layer, key, action_type and action.
+    fields = ("device", "layer", "key", action_type_tag, action_tag)
+    with open(keybinds_file, newline="") as f:
+        if keybinds_file.lower().endswith(".csv"):
+            keybinds = []
+            for row in csv.DictReader(f):
+                action = row.get(action_tag, "") or ""
+                if row.get(action_type_tag, None) in (action_exec_tag, action_keyboard_tag, action_multi_tag) and action.lstrip().startswith(("[", "{")):
+                    # Lists and objects (exec arguments, keyboard keys, multi actions) are written as JSON.
+                    # Anything else, like the shell test "[ -f file ]", is taken as it is.
+                    try:
+                        action = json.loads(action)
+                    except JSONDecodeError:
+                        pass
+                keybinds.append({**row, action_tag: action})
+        else:
+            keybinds = json.load(f)
+    if not isinstance(keybinds, list):
+        raise ValueError("keybinds must be a list")
+    for line, keybind in enumerate(keybinds, 1):
+        if not isinstance(keybind, dict) or any(keybind.get(field, None) in (None, "") for field in fields if field != action_type_tag):
+            raise ValueError(f"keybind [ {line} ] needs the fields {', '.join(fields[:3])} and {action_tag}")
+    return keybinds
+
+def import_keybinds(keybinds_file, config_file):
+    # Adds every keybind in one transaction, replacing existing binds for the same keys.
+    # Devices and layers that don't exist yet are created empty, without the sample keybinds.
+    keybinds = read_keybinds(keybinds_file)
+    with ConfigTransaction(config_file) as transaction:
+        for keybind in keybinds:
+            transaction.add_device(keybind["device"], {**blank_device(), layers_tag: {}})
+            transaction.add_keybind(keybind["device"], keybind["layer"], keybind["key"], keybind.get(action_type_tag, "") or action_shell_tag, keybind[action_tag], True, {keybinds_tag: {}})
+    return len(keybinds)
 
 
 def get_first_layer(device_config):
@@ -262,158 +1695,1291 @@ class StringContainer():
     def __str__(self):
         return self.get_string()
 
-def run_device(device, config_file):
-    device_short = device
-    if shorten_name_amount != -1 and len(device_short) > shorten_name_amount:
-        device_short = device_short[:shorten_name_amount] + "..."
-    dev_no_config_msg = f"Device [ {device_short} ] is not in the configuration, skipping..."
-    invalid_dev_msg = f"Device [ {device_short} ] is invalid, skipping..."
-    error_msg = gen_log_msg(device_short, "", f"Hit a critical error, stopping...")
-    config = read_config(config_file)
-    devices = config.get(devices_tag, {})
-    if device in devices.keys():
-        device_short = devices[device].get(device_nickname_tag, device_short)
+class ThreadActions():
+    # Runs dispatched actions for the threaded engine. Commands are spawned right away and reaped by a
+    # shared ProcessRunner, keyboard actions are played by a shared KeyScheduler.
+    def __init__(self, key_scheduler, process_runner, device, fake_dev):
+        self.key_scheduler = key_scheduler
+        self.process_runner = process_runner
+        self.device = device
+        self.fake_dev = fake_dev
+
+    def run_shell(self, cmd, device="", current_layer="", print_output=True, trace=None, done=None):
+        self.process_runner.spawn((shell_def, "-c", cmd), device, current_layer, print_output, done)
+        record_trace(trace, stage_output_tag)
+
+    def run_exec(self, argv, device="", current_layer="", print_output=True, trace=None, done=None):
+        self.process_runner.spawn(argv, device, current_layer, print_output, done)
+        record_trace(trace, stage_output_tag)
+
+    def run_keys(self, keys, trace=None, done=None):
+        self.key_scheduler.play(self.fake_dev, keys, trace, done)
+
+class AsyncActions():
+    # Runs dispatched actions as tasks on the running event loop, used by the async engine.
+    def __init__(self, fake_dev):
+        self.fake_dev = fake_dev
+        self.tasks = set()
+        self.keys_end = 0.0
+        self.keys_task = None
+
+    def start_task(self, coroutine, done=None):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+        if done is not None:
+            task.add_done_callback(lambda task: done())
+        return task
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log(log_error, msg=f"Action hit an error, ignoring...: {str(task.exception())}")
+
+    def run_shell(self, cmd, device="", current_layer="", print_output=True, trace=None, done=None):
+        self.start_task(async_exec_cmd(cmd, device, current_layer, print_output, trace), done)
+
+    def run_exec(self, argv, device="", current_layer="", print_output=True, trace=None, done=None):
+        self.start_task(async_exec_cmd(argv, device, current_layer, print_output, trace), done)
+
+    def run_keys(self, keys, trace=None, done=None):
+        start = max(asyncio.get_running_loop().time(), self.keys_end)
+        self.keys_end = start + keys[0]
+        self.keys_task = self.start_task(async_play_keys(keys, self.fake_dev, start, self.keys_task, trace), done)
+
+    async def wait(self):
+        if len(self.tasks) > 0:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+class DeviceDispatcher():
+    # Turns input events from one device into actions, independent of how events are read or actions run.
+    def __init__(self, device, config_manager, actions=None, stats=None):
+        self.device = device
+        self.config_manager = config_manager
+        self.actions = actions
+        self.stats = stats
+        self.device_short = shorten_name(device)
+        self.dev_no_config_msg = f"Device [ {self.device_short} ] is not in the configuration, skipping..."
+        self.current_layer = StringContainer()
+        # Per (layer, key code) state for binds with options, see throttle(). Each layer's bind has its own.
+        self.last_press = {}
+        self.in_flight = {}
+        self.held = {} # Key code -> [(layer, key code), next repeat, repeat interval] for held keys of binds with a repeat_rate.
+        self.in_flight_lock = Lock()
+        self.compiled_device = config_manager.get().devices.get(device, None)
+        if self.compiled_device is not None:
+            self.device_short = self.compiled_device[device_nickname_tag] or self.device_short
+            self.set_layer_default()
+
+    def set_layer_default(self):
+        self.current_layer.set_string(self.compiled_device[first_layer_tag])
+
+    def throttle(self, bind_key, options, value):
+        # Applies a bind's (debounce, repeat interval, max in flight) options to a press (value 1) or a repeat (value 2).
+        # bind_key is (layer, key code). Returns the option that stops the bind from running now, or None after counting it as started.
+        debounce, repeat_interval, max_in_flight = options
+        if value == 1:
+            now = monotonic()
+            if debounce > 0 and now - self.last_press.get(bind_key, -debounce) < debounce:
+                return debounce_tag
+            self.last_press[bind_key] = now
+        elif repeat_interval == 0:
+            return repeat_rate_tag
+        if max_in_flight > 0:
+            with self.in_flight_lock:
+                if self.in_flight.get(bind_key, 0) >= max_in_flight:
+                    return max_in_flight_tag
+                self.in_flight[bind_key] = self.in_flight.get(bind_key, 0) + 1
+        return None
+
+    def repeat_timeout(self):
+        # Seconds until the next held key repeats, or None while no key with a repeat_rate is held.
+        if len(self.held) == 0:
+            return None
+        return max(0.0, min(held[1] for held in self.held.values()) - monotonic())
+
+    def repeat_held(self):
+        # Runs the binds of held keys whose repeat is due, called by the read loops whenever they wake up.
+        # Repeats are timed here rather than by the kernel's autorepeat, which many devices don't have.
+        if len(self.held) == 0:
+            return
+        now = monotonic()
+        for code, held in list(self.held.items()):
+            bind_key, due, repeat_interval = held
+            if due > now:
+                continue
+            if bind_key[0] != self.current_layer.get_string():
+                # The layer changed under the held key, its bind is gone.
+                del self.held[code]
+                continue
+            # Repeats keep their fixed rate, but repeats missed while busy are skipped rather than run in a burst.
+            held[1] = due + repeat_interval if due + repeat_interval > now else now + repeat_interval
+            compiled_device = self.config_manager.get().devices.get(self.device, None)
+            if compiled_device is not None:
+                self.press(compiled_device, code, 2)
+
+    def instance_done(self, instance):
+        # instance is [(layer, code), unfinished steps], a bind run counts as in flight until all of its steps finished.
+        with self.in_flight_lock:
+            instance[1] -= 1
+            if instance[1] == 0:
+                self.in_flight[instance[0]] -= 1
+
+    def handle_event(self, event):
+        # Returns False once the device should stop.
+        value = event.value
+        if event.type != ecodes.EV_KEY or value == 2:
+            # The kernel's autorepeat is ignored, binds with a repeat_rate repeat on their own (see repeat_held()).
+            return True
+        if value == 0:
+            if len(self.held) > 0:
+                self.held.pop(event.code, None)
+            return True
+        stats = self.stats
+        received = origin = None
+        if stats is not None:
+            received = monotonic()
+            # Kernel timestamps use the wall clock, so turn the event time into a monotonic origin.
+            origin = received - (time() - event.timestamp())
+        compiled_device = self.config_manager.get().devices.get(self.device, None)
+        if compiled_device is None:
+            log(log_warning, msg=self.dev_no_config_msg)
+            return False
+        return self.press(compiled_device, event.code, value, received, origin)
+
+    def press(self, compiled_device, code, value, received=None, origin=None):
+        # Runs the bind of a pressed (value 1) or repeating (value 2) key. Returns False once the device should stop.
+        # Latency stats are only recorded for presses read from the device, which have an origin.
+        stats = self.stats if origin is not None else None
+        trace = None
+        self.compiled_device = compiled_device
+        self.device_short = compiled_device[device_nickname_tag] or self.device_short
+        device_short = self.device_short
+        current_layer = self.current_layer
+        if value == 1 and logger.enabled(log_debug, device_short):
+            log(log_debug, device_short, current_layer.get_string(), f"Pressed key: [ {ecodes.KEY.get(code, code)} ]", True)
+        if code in compiled_device[exit_codes_tag] and value == 1:
+            log(log_info, device_short, current_layer.get_string(), "Exit key pressed! Quitting...")
+            exit_cmd = compiled_device[exit_cmd_tag]
+            if isinstance(exit_cmd, str):
+                try:
+                    self.actions.run_shell(exit_cmd)
+                except:
+                    log(log_error, device_short, current_layer.get_string(), f"Device [ {device_short} ] hit an error while running its exit command [ {exit_cmd} ], ignoring...")
+            return False
+        keymap = compiled_device[keymaps_tag].get(current_layer.get_string(), None)
+        if keymap is None:
+            self.set_layer_default()
+            return True
+        plan = keymap.get(code, None)
+        options = None
+        if plan is not None:
+            layer_options = compiled_device[bind_options_tag].get(current_layer.get_string(), None)
+            if layer_options is not None:
+                options = layer_options.get(code, None)
+        if value != 1:
+            if options is None or options[1] == 0:
+                # The config changed while the key was held, and the bind no longer repeats.
+                self.held.pop(code, None)
+                return True
+            self.held[code][2] = options[1]
+        if options is not None:
+            # Enforced before anything is started, so skipped presses cost no process or keyboard action.
+            skipped_by = self.throttle((current_layer.get_string(), code), options, value)
+            if value == 1 and options[1] > 0 and skipped_by != debounce_tag:
+                self.held[code] = [(current_layer.get_string(), code), monotonic() + options[1], options[1]]
+            if skipped_by is not None:
+                if value == 1 and logger.enabled(log_debug, device_short):
+                    log(log_debug, device_short, current_layer.get_string(), f"Skipped key: [ {ecodes.KEY.get(code, code)} ] because of its [ {skipped_by} ]", True)
+                return True
+        if stats is not None:
+            stats.record(device_short, current_layer.get_string(), None, stage_queue_tag, received - origin)
+            stats.record(device_short, current_layer.get_string(), None, stage_resolve_tag, monotonic() - received)
+        if plan is not None:
+            print_actions = logger.enabled(log_info, device_short)
+            done = None
+            if options is not None and options[2] > 0:
+                # Held at one unfinished step until every step was started, so the run can't finish early.
+                instance = [(current_layer.get_string(), code), 1]
+                done = lambda: self.instance_done(instance)
+            for action_type, action in plan:
+                if stats is not None:
+                    trace = (stats, device_short, current_layer.get_string(), action_type, origin)
+                    record_trace(trace, stage_action_start_tag)
+                if done is not None and action_type != action_set_layer_tag:
+                    with self.in_flight_lock:
+                        instance[1] += 1
+                if action_type == action_shell_tag:
+                    if print_actions:
+                        log(log_info, device_short, current_layer.get_string(), f"Running in system shell: [ {action} ]")
+                    try:
+                        self.actions.run_shell(action, device_short, current_layer.get_string(), print_actions, trace, done)
+                    except:
+                        log(log_error, device_short, current_layer.get_string(), f"Hit an error while running shell command [ {action} ], ignoring...")
+                        if done is not None:
+                            done()
+                elif action_type == action_exec_tag:
+                    if print_actions:
+                        log(log_info, device_short, current_layer.get_string(), f"Running: [ {shlex.join(action)} ]")
+                    try:
+                        self.actions.run_exec(action, device_short, current_layer.get_string(), print_actions, trace, done)
+                    except Exception as error:
+                        log(log_error, device_short, current_layer.get_string(), f"Hit an error while running command [ {shlex.join(action)} ], ignoring...: {str(error)}")
+                        if done is not None:
+                            done()
+                elif action_type == action_keyboard_tag:
+                    self.actions.run_keys(action, trace, done)
+                elif action_type == action_macro_tag:
+                    if print_actions:
+                        log(log_info, device_short, current_layer.get_string(), f"Playing macro: [ {action[0]} ]")
+                    try:
+                        timeline = get_macro_timeline(*action)
+                    except (OSError, ValueError) as error:
+                        log(log_error, device_short, current_layer.get_string(), f"Could not load macro [ {action[0]} ], ignoring...: {str(error)}")
+                        if done is not None:
+                            done()
+                    else:
+                        self.actions.run_keys(timeline, trace, done)
+                elif action_type == action_set_layer_tag:
+                    if print_actions:
+                        log(log_info, device_short, "", f"Switching to layer: [ {action} ], From Layer: [ {current_layer.get_string()} ]")
+                    current_layer.set_string(action)
+            if done is not None:
+                done()
+        return True
+
+
+class DeviceWatcher():
+    # Watches the input directory (and its by-id and by-path links) with inotify and wakes up every device
+    # waiting to be plugged in (again) on any change, so they are attached right away without polling.
+    def __init__(self):
+        self.condition = Condition()
+        self.changes = 0
+        self.listeners = [] # Functions called from the watcher thread on every change, for the async engine.
+        self.inotify = None
+        self.attached = 0 # Devices currently attached.
+        self.stopping = False # Set once every attached device has stopped, devices still waiting then stop too.
+        self.attached_listener = None # Called with the number of attached devices whenever it changes, for supervised workers.
+
+    def start(self):
+        # Returns False if devices can't be watched, they are then only attached at start, as before.
+        try:
+            self.inotify = Inotify()
+            self.inotify.add_watch(input_dir_def, IN_CREATE | IN_ATTRIB | IN_DELETE | IN_MOVED_TO)
+        except (OSError, AttributeError) as error:
+            if self.inotify is not None:
+                self.inotify.close()
+                self.inotify = None
+            log(log_warning, msg=f"Can't watch [ {input_dir_def} ] for devices being plugged in, missing or unplugged devices won't be attached again: {str(error)}")
+            return False
+        for name in ("by-id", "by-path"):
+            self.watch_links(name)
+        run_thread(self.watch_loop, (), daemon=True)
+        return True
+
+    def watch_links(self, name):
+        try:
+            self.inotify.add_watch(os.path.join(input_dir_def, name), IN_CREATE | IN_DELETE | IN_MOVED_TO)
+        except OSError:
+            return # Created by udev with the first such device, see watch_loop.
+        # Waiting devices look again only once the watch is in place, so links created before it aren't missed.
+        self.changed()
+
+    def attach(self):
+        with self.condition:
+            self.attached += 1
+            attached = self.attached
+        if self.attached_listener is not None:
+            self.attached_listener(attached)
+
+    def detach(self, stopped):
+        # stopped is False for an unplugged device that waits to be attached again.
+        # Once the last attached device stopped, waiting for the others would keep keysboard running for nothing.
+        with self.condition:
+            self.attached -= 1
+            attached = self.attached
+            stopping = stopped and attached == 0
+            if stopping:
+                self.stopping = True
+        if self.attached_listener is not None:
+            self.attached_listener(attached)
+        if stopping:
+            self.changed()
+
+    def changed(self):
+        with self.condition:
+            self.changes += 1
+            self.condition.notify_all()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener()
+
+    def watch_loop(self):
+        while True:
+            for path, mask, name in self.inotify.read_events():
+                if mask & IN_ISDIR and path == input_dir_def and name in ("by-id", "by-path"):
+                    self.watch_links(name)
+            self.changed()
+
+    def wait(self, changes):
+        # Blocks until something changed since changes was read from self.changes.
+        with self.condition:
+            while self.changes == changes:
+                self.condition.wait()
+
+    def add_listener(self, listener):
+        with self.condition:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self.condition:
+            self.listeners.remove(listener)
+
+def get_device_paths(dispatcher):
+    # The configured path comes first, it can be a raw event device or a stable /dev/input/by-id or by-path link.
+    # Without it, every input device is a candidate when the device has a device_name to match.
+    if os.path.exists(dispatcher.device) or dispatcher.compiled_device[device_name_tag] is None:
+        return [dispatcher.device]
+    try:
+        return sorted(os.path.join(input_dir_def, name) for name in os.listdir(input_dir_def) if name.startswith("event"))
+    except OSError:
+        return []
+
+def grab_device(dispatcher, log_missing=True):
+    # Returns the grabbed InputDevice, or None if it can't be used. Without log_missing, a device that isn't
+    # plugged in is expected and not logged, but one that can't be opened or grabbed still is.
+    device_name = dispatcher.compiled_device[device_name_tag]
+    for path in get_device_paths(dispatcher):
+        try:
+            dev = InputDevice(path)
+        except IOError as error:
+            if path == dispatcher.device and error.errno != errno.ENOENT:
+                log(log_warning, dispatcher.device_short, "", f"[ {path} ] can't be opened, skipping...: {str(error)}")
+            continue
+        if path != dispatcher.device and dev.name != device_name:
+            dev.close()
+            continue
+        try:
+            dev.grab()
+        except IOError:
+            log(log_warning, dispatcher.device_short, "", f"[ {path} ] is already grabbed, skipping...")
+            dev.close()
+            continue
+        return dev
+    if log_missing:
+        log(log_warning, dispatcher.device_short, "", "Device is invalid, skipping...")
+    return None
+
+def release_device(dev):
+    try:
+        dev.ungrab()
+    except IOError:
+        pass
+    dev.close()
+
+##########
+# Control Socket
+##########
+# A running keysboard answers newline separated JSON commands on a Unix socket, one JSON line per command:
+#     {"command": "set_layer", "device": "/dev/input/by-id/...", "layer": "music"}
+#     {"ok": true, "config_file": "/path/to/config.json"} or {"ok": false, "error": "...", "config_file": "..."}
+# Commands: ping, devices, set_layer (device, layer), add_device (device), add_layer (device, layer),
+# add_keybind (device, layer, key, action_type, action, replace), remove_keybind (device, layer, key), reload and stats.
+# Devices can be given by path or nickname. Edits only change the running config unless "save" is true.
+class ControlServer():
+    def __init__(self, socket_file, config_manager, latency_stats=None):
+        self.socket_file = socket_file
+        self.config_manager = config_manager
+        self.config_file = os.path.abspath(config_manager.config_file)
+        self.latency_stats = latency_stats
+        self.counters = {} # Name -> function returning a dict of extra counters for the stats command.
+        self.dispatchers = {}
+        self.lock = Lock()
+        self.sock = None
+        self.commands = {
+            "ping": lambda request: {},
+            "devices": self.list_devices,
+            "set_layer": self.set_layer,
+            "add_device": lambda request: self.edit_config(request, lambda transaction: transaction.add_device(self.get_device(request))),
+            "add_layer": lambda request: self.edit_config(request, lambda transaction: transaction.add_layer(self.get_device(request), get_control_field(request, "layer"))),
+            "add_keybind": lambda request: self.edit_config(request, lambda transaction: transaction.add_keybind(self.get_device(request), get_control_field(request, "layer"), get_control_field(request, key_tag), get_control_field(request, action_type_tag), get_control_field(request, action_tag), request.get("replace", False) is True)),
+            "remove_keybind": lambda request: self.edit_config(request, lambda transaction: transaction.remove_keybind(self.get_device(request), get_control_field(request, "layer"), get_control_field(request, key_tag))),
+            "reload": lambda request: {"reloaded": self.config_manager.reload(True)},
+            "stats": self.get_stats,
+        }
+
+    def register(self, dispatcher):
+        with self.lock:
+            self.dispatchers[dispatcher.device] = dispatcher
+
+    def unregister(self, dispatcher):
+        with self.lock:
+            if self.dispatchers.get(dispatcher.device, None) is dispatcher:
+                del self.dispatchers[dispatcher.device]
+
+    def get_device(self, request):
+        # Returns the path of the requested device, which can also be given by nickname when no device has that path.
+        device = get_control_field(request, "device")
+        devices = self.config_manager.get().devices
+        if device not in devices:
+            for path, compiled_device in devices.items():
+                if compiled_device[device_nickname_tag] == device:
+                    return path
+        return device
+
+    def get_dispatcher(self, request):
+        device = self.get_device(request)
+        with self.lock:
+            if device in self.dispatchers:
+                return self.dispatchers[device]
+        raise ValueError(f"device [ {device} ] is not running")
+
+    def list_devices(self, request):
+        with self.lock:
+            dispatchers = dict(self.dispatchers)
+        devices = {}
+        for device, compiled_device in self.config_manager.get().devices.items():
+            dispatcher = dispatchers.get(device, None)
+            devices[device] = {
+                device_nickname_tag: compiled_device[device_nickname_tag],
+                "layer": dispatcher.current_layer.get_string() if dispatcher is not None else None,
+                layers_tag: list(compiled_device[keymaps_tag].keys())
+            }
+        return {devices_tag: devices}
+
+    def set_layer(self, request):
+        dispatcher = self.get_dispatcher(request)
+        layer = get_control_field(request, "layer")
+        compiled_device = self.config_manager.get().devices.get(dispatcher.device, None)
+        if compiled_device is None or layer not in compiled_device[keymaps_tag]:
+            raise ValueError(f"layer [ {layer} ] is not in device [ {dispatcher.device} ]")
+        log(log_info, dispatcher.device_short, "", f"Switching to layer: [ {layer} ], From Layer: [ {dispatcher.current_layer.get_string()} ] (control socket)")
+        dispatcher.current_layer.set_string(layer)
+        return {}
+
+    def edit_config(self, request, edit):
+        def apply(config):
+            with ConfigTransaction(None, config) as transaction:
+                edit(transaction)
+            return transaction.changed
+        snapshot = self.config_manager.edit(apply)
+        if request.get(control_save_tag, False) is True:
+            save_config(snapshot.config, self.config_manager.config_file)
+        return {}
+
+    def get_stats(self, request):
+        stats = self.latency_stats.dump() if self.latency_stats is not None else {"time": time()}
+        for name, counters in self.counters.items():
+            stats[name] = counters()
+        return {"stats": stats}
+
+    def handle_line(self, line):
         try:
-            dev = InputDevice(device)
+            request = json.loads(line)
+            if not isinstance(request, dict) or request.get(control_command_tag, None) not in self.commands:
+                raise ValueError(f"unknown command, valid commands: {', '.join(self.commands.keys())}")
+            if control_config_file_tag in request and request[control_config_file_tag] != self.config_file:
+                raise ValueError(f"running with config [ {self.config_file} ]")
+            response = self.commands[request[control_command_tag]](request)
+            response[control_ok_tag] = True
+        except (JSONDecodeError, UnicodeDecodeError, ValueError, TypeError, ConfigError, OSError) as error:
+            response = {control_ok_tag: False, control_error_tag: str(error)}
+        except Exception as error:
+            # A bug in one command mustn't take down the control socket for everyone.
+            log(log_error, msg=f"Control command [ {line.decode('utf-8', 'replace').strip()} ] hit an error, ignoring...: {str(error)}")
+            response = {control_ok_tag: False, control_error_tag: f"internal error: {str(error)}"}
+        response[control_config_file_tag] = self.config_file
+        return (json.dumps(response) + "\n").encode()
+
+    def start(self):
+        # Returns False if another keysboard already answers on the socket or it can't be created.
+        if send_control({control_command_tag: "ping"}, self.socket_file) is not None:
+            log(log_warning, msg=f"Another keysboard is listening on [ {self.socket_file} ], running without the control socket.")
+            return False
+        try:
+            mkdir_p(os.path.dirname(self.socket_file))
             try:
-                dev.grab()
-                device_config = devices[device]
-                current_layer = StringContainer()
-                def set_layer_default():
-                    current_layer.set_string(device_config.get(first_layer_tag, get_first_layer(device_config)))
-                set_layer_default()
-                fake_dev = uinput.UInput()
-                for event in dev.read_loop():
-                    if event.type == ecodes.EV_KEY:
-                        key = categorize(event)
-                        if key.keystate == key.key_down:
-                            config = read_config(config_file)
-                            devices = config.get(devices_tag, {})
-                            if device in devices:
-                                device_config = devices[device]
-                                device_aliases = device_config.get(aliases_tag, {})
-                                device_short = device_config.get(device_nickname_tag, device_short)
-                                code = key.keycode
-                                if print_key_codes_tag in device_config.keys():
-                                    print_key_codes = device_config[print_key_codes_tag]
-                                else:
-                                    print_key_codes = True
-                                if print_key_codes:
-                                    print(gen_log_msg(device_short, current_layer.get_string(), f"Pressed key: [ {code} ]"))
-                                exit_key = device_config.get(exit_key_tag, None)
-                                if code == exit_key or code == universal_exit_key:
-                                    print(gen_log_msg(device_short, current_layer.get_string(), "Exit key pressed! Quitting..."))
-                                    if exit_cmd_tag in device_config:
-                                        exit_cmd = device_config[exit_cmd_tag]
-                                        if isinstance(exit_cmd, str):
-                                            try:
-                                                run_thread(exec_cmd, (exit_cmd,))
-                                            except:
-                                                print(gen_log_msg(device_short, current_layer.get_string(), f"Device [ {device_short} ] hit an error while running its exit command [ {exit_cmd} ], ignoring..."))
-                                    break
-                                else:
-                                    layers = device_config.get(layers_tag, {})
-                                    if current_layer.get_string() in layers:
-                                        keybinds = {}
-                                        inherited_layers = layers[current_layer.get_string()].get(inherit_tag, [])
-                                        if isinstance(inherited_layers, str) and inherited_layers in layers.keys():
-                                            inherited_layers = layers[inherited_layers]
-                                        if isinstance(inherited_layers, list):
-                                            for inherited_layer in inherited_layers:
-                                                if inherited_layer in layers:
-                                                    keybinds.update(layers[inherited_layer].get(keybinds_tag, {}))
-                                        keybinds.update(layers[current_layer.get_string()].get(keybinds_tag, {}))
-                                        for key in keybinds.keys():
-                                            if (isinstance(code, list) and key in code) or (isinstance(code, str) and code == key):
-                                                old_aliases = []
-                                                def exec_action(bind):
-                                                    if action_tag in bind.keys():
-                                                        action = bind[action_tag]
-                                                        action_type = ""
-                                                        if print_actions_tag in device_config:
-                                                            print_actions = device_config[print_actions_tag]
-                                                        else:
-                                                            print_actions = True
-                                                        if action_type_tag in bind:
-                                                            action_type = bind[action_type_tag]
-                                                        if action_type == action_shell_tag or action_type == "":
-                                                            if print_actions:
-                                                                print(gen_log_msg(device_short, current_layer.get_string(), f"Running in system shell: [ {action} ]"))
-                                                            try:
-                                                                run_thread(exec_cmd, (action, device_short, current_layer.get_string(), print_actions,))
-                                                            except:
-                                                                print(gen_log_msg(device_short, current_layer.get_string(), f"Hit an error while running shell command [ {action} ], ignoring..."))
-                                                        elif action_type == action_keyboard_tag:
-                                                            if type(action) is list:
-                                                                run_thread(press_keys, (action, fake_dev,))
-                                                            elif key_tag in action.keys():
-                                                                code = action[key_tag]
-                                                                if set_key_tag in action.keys():
-                                                                    run_thread(set_key, (code, bind[set_key_tag], fake_dev,))
-                                                                else:
-                                                                    run_thread(press_key, (code, bind.get(hold_time_tag, hold_time_def,), fake_dev))
-                                                        elif action_type == action_set_layer_tag:
-                                                            if action in layers.keys():
-                                                                if print_actions:
-                                                                    print(gen_log_msg(device_short, "", f"Switching to layer: [ {action} ], From Layer: [ {current_layer.get_string()} ]"))
-                                                                current_layer.set_string(action)
-                                                            else:
-                                                                print(gen_log_msg(device_short, current_layer.get_string(), f"Layer [ {action} ] is not in config, ignoring..."))
-                                                        elif action_type == action_alias_tag:
-                                                            if action in device_aliases.keys():
-                                                                if action in old_aliases:
-                                                                    print(gen_log_msg(device_short, current_layer.get_string(), f"Action alias [ {action} ] has been recursively called, skipping..."))
-                                                                else:
-                                                                    old_aliases.append(action)
-                                                                    exec_action(device_aliases[action])
-                                                            else:
-                                                                print(gen_log_msg(device_short, current_layer.get_string(), f"Action alias [ {action} ] is undefined, skipping..."))
-                                                        elif action_type == action_multi_tag:
-                                                            if isinstance(action, list):
-                                                                for sub_action in action:
-                                                                    exec_action(sub_action)
-                                                                    if isinstance(sub_action, dict):
-                                                                        sub_action_type = sub_action.get(action_type_tag, "")
-                                                                        if sub_action_type == action_alias_tag and action_tag in sub_action and sub_action[action_tag] in old_aliases:
-                                                                            old_aliases.remove(sub_action[action_tag])
-                                                            else:
-                                                                print(gen_log_msg(device, current_layer.get_string(), f"Multi-Action [ {action} ] is not of type list, skipping..."))
-                                                exec_action(keybinds[key])
-                                    else:
-                                        set_layer_default()
-                            else:
-                                print(dev_no_config_msg)
-                                break
-            except IOError:
-                print(gen_log_msg(device_short, "", "Already grabbed, skipping..."))
-                pass
-            except Exception as error:
-                print(f"{error_msg}: {str(error)}")
+                st = os.lstat(self.socket_file)
+            except FileNotFoundError:
+                st = None
+            if st is not None:
+                if not stat.S_ISSOCK(st.st_mode):
+                    log(log_error, msg=f"[ {self.socket_file} ] exists and is not a socket, running without the control socket.")
+                    return False
+                os.remove(self.socket_file) # Left over by a keysboard that didn't exit cleanly.
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            # Created owner-only from the start, so no other user can connect before it's chmodded.
+            umask = os.umask(0o177)
+            try:
+                sock.bind(self.socket_file)
+            finally:
+                os.umask(umask)
+            os.chmod(self.socket_file, 0o600)
+            sock.listen(16)
+        except OSError as error:
+            log(log_warning, msg=f"Could not create the control socket [ {self.socket_file} ], running without it: {str(error)}")
+            return False
+        self.sock = sock
+        run_thread(self.serve_loop, (), daemon=True)
+        return True
+
+    def stop(self):
+        if self.sock is not None:
+            try:
+                os.remove(self.socket_file)
+            except OSError:
                 pass
+
+    def serve_loop(self):
+        # Serves every client from one thread. Commands are cheap, so they are answered right away in order.
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
+        buffers = {}
+        def close(conn):
+            selector.unregister(conn)
+            del buffers[conn]
+            conn.close()
+        while True:
+            for key, mask in selector.select():
+                if key.fileobj is self.sock:
+                    try:
+                        conn = self.sock.accept()[0]
+                    except OSError:
+                        continue
+                    # A client that stops reading its answers is dropped instead of blocking everyone else.
+                    conn.settimeout(control_timeout_def)
+                    selector.register(conn, selectors.EVENT_READ)
+                    buffers[conn] = b""
+                    continue
+                conn = key.fileobj
+                try:
+                    data = conn.recv(65536)
+                except OSError:
+                    data = b""
+                if len(data) == 0:
+                    close(conn)
+                    continue
+                *lines, buffers[conn] = (buffers[conn] + data).split(b"\n")
+                try:
+                    for line in lines:
+                        if len(line.strip()) > 0:
+                            conn.sendall(self.handle_line(line))
+                except OSError:
+                    close(conn)
+
+def get_control_field(request, name):
+    if request.get(name, None) in (None, ""):
+        raise ValueError(f"missing field [ {name} ]")
+    return request[name]
+
+def send_control(request, socket_file=control_socket_def):
+    # Sends one command to a running keysboard and returns its answer, or None if none is listening.
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(control_timeout_def)
+            sock.connect(socket_file)
+            sock.sendall((json.dumps(request) + "\n").encode())
+            with sock.makefile("rb") as f:
+                return json.loads(f.readline())
+    except (OSError, JSONDecodeError, UnicodeDecodeError):
+        return None
+
+def send_control_edit(request, config_file, socket_file=control_socket_def):
+    # Lets a running keysboard using config_file apply and save an edit, so it takes effect without a reload.
+    # Returns False if there is none and the file should be edited directly.
+    if socket_file is None:
+        return False
+    response = send_control({**request, control_save_tag: True, control_config_file_tag: os.path.abspath(config_file)}, socket_file)
+    if response is None or response.get(control_config_file_tag, None) != os.path.abspath(config_file):
+        return False
+    if not response.get(control_ok_tag, False):
+        print(f"The running keysboard could not apply the change: {response.get(control_error_tag, '')}")
+    return True
+
+
+def run_device(device, config_manager, key_scheduler, process_runner, latency_stats=None, control_server=None, device_watcher=None):
+    # Returns True once the device stopped on its exit key, None if it couldn't be grabbed and False if it stopped on an error.
+    # With a device_watcher, a missing or unplugged device is waited for and attached again, in the layer it was in.
+    dispatcher = DeviceDispatcher(device, config_manager, stats=latency_stats)
+    if dispatcher.compiled_device is None:
+        log(log_warning, msg=dispatcher.dev_no_config_msg)
+        return True
+    fake_dev = LazyUInput()
+    dispatcher.actions = ThreadActions(key_scheduler, process_runner, device, fake_dev)
+    if control_server is not None:
+        control_server.register(dispatcher)
+    attached = False
+    try:
+        waiting = False
+        while True:
+            changes = device_watcher.changes if device_watcher is not None else None
+            if device_watcher is not None and device_watcher.stopping:
+                log(log_info, dispatcher.device_short, "", "Every attached device has stopped, no longer waiting for it.")
+                return True
+            dev = grab_device(dispatcher, device_watcher is None)
+            if dev is None:
+                if device_watcher is None:
+                    return None
+                if config_manager.get().devices.get(device, None) is None:
+                    log(log_warning, msg=dispatcher.dev_no_config_msg)
+                    return True
+                if not waiting:
+                    log(log_info, dispatcher.device_short, "", "Not connected, waiting for it...")
+                    waiting = True
+                device_watcher.wait(changes)
+                continue
+            if device_watcher is not None:
+                device_watcher.attach()
+                attached = True
+            if waiting:
+                log(log_info, dispatcher.device_short, dispatcher.current_layer.get_string(), "Connected.")
+                waiting = False
+            try:
+                with selectors.DefaultSelector() as selector:
+                    selector.register(dev.fd, selectors.EVENT_READ)
+                    while True:
+                        # Like dev.read_loop(), but also wakes up when a held key is due to repeat.
+                        if len(selector.select(dispatcher.repeat_timeout())) > 0:
+                            for event in dev.read():
+                                if not dispatcher.handle_event(event):
+                                    return True
+                        dispatcher.repeat_held()
+            except OSError as error:
+                if device_watcher is None or error.errno != errno.ENODEV:
+                    raise
+                log(log_info, dispatcher.device_short, dispatcher.current_layer.get_string(), "Disconnected, waiting for it to come back...")
+                dispatcher.held.clear()
+                device_watcher.detach(False)
+                attached = False
+                waiting = True
             finally:
+                release_device(dev)
+    except Exception as error:
+        log(log_error, dispatcher.device_short, "", f"Hit a critical error, stopping...: {str(error)}")
+        return False
+    finally:
+        if attached:
+            device_watcher.detach(True)
+        if control_server is not None:
+            control_server.unregister(dispatcher)
+        key_scheduler.wait(fake_dev)
+        fake_dev.close()
+
+async def async_run_device(device, config_manager, latency_stats=None, control_server=None, device_watcher=None):
+    dispatcher = DeviceDispatcher(device, config_manager, stats=latency_stats)
+    if dispatcher.compiled_device is None:
+        log(log_warning, msg=dispatcher.dev_no_config_msg)
+        return
+    fake_dev = LazyUInput()
+    actions = AsyncActions(fake_dev)
+    dispatcher.actions = actions
+    changed = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    listener = lambda: loop.call_soon_threadsafe(changed.set)
+    if device_watcher is not None:
+        device_watcher.add_listener(listener)
+    if control_server is not None:
+        control_server.register(dispatcher)
+    attached = False
+    try:
+        waiting = False
+        while True:
+            changed.clear()
+            if device_watcher is not None and device_watcher.stopping:
+                log(log_info, dispatcher.device_short, "", "Every attached device has stopped, no longer waiting for it.")
+                return
+            dev = grab_device(dispatcher, device_watcher is None)
+            if dev is None:
+                if device_watcher is None:
+                    return
+                if config_manager.get().devices.get(device, None) is None:
+                    log(log_warning, msg=dispatcher.dev_no_config_msg)
+                    return
+                if not waiting:
+                    log(log_info, dispatcher.device_short, "", "Not connected, waiting for it...")
+                    waiting = True
+                await changed.wait()
+                continue
+            if device_watcher is not None:
+                device_watcher.attach()
+                attached = True
+            if waiting:
+                log(log_info, dispatcher.device_short, dispatcher.current_layer.get_string(), "Connected.")
+                waiting = False
+            read = None
+            try:
+                while True:
+                    # Like dev.async_read_loop(), but also wakes up when a held key is due to repeat. The read
+                    # is waited for without cancelling it on timeouts, so no events are lost.
+                    if read is None:
+                        read = dev.async_read()
+                    await asyncio.wait((read,), timeout=dispatcher.repeat_timeout())
+                    if read.done():
+                        events, read = read.result(), None
+                        for event in events:
+                            if not dispatcher.handle_event(event):
+                                return
+                    dispatcher.repeat_held()
+            except OSError as error:
+                if device_watcher is None or error.errno != errno.ENODEV:
+                    raise
+                log(log_info, dispatcher.device_short, dispatcher.current_layer.get_string(), "Disconnected, waiting for it to come back...")
+                dispatcher.held.clear()
+                device_watcher.detach(False)
+                attached = False
+                waiting = True
+            finally:
+                if read is not None and not read.done():
+                    loop.remove_reader(dev.fd)
+                    read.cancel()
+                release_device(dev)
+    except Exception as error:
+        log(log_error, dispatcher.device_short, "", f"Hit a critical error, stopping...: {str(error)}")
+    finally:
+        if attached:
+            device_watcher.detach(True)
+        if device_watcher is not None:
+            device_watcher.remove_listener(listener)
+        if control_server is not None:
+            control_server.unregister(dispatcher)
+        await actions.wait()
+        fake_dev.close()
+
+async def async_run_devices(devices, config_manager, latency_stats=None, control_server=None, device_watcher=None):
+    await asyncio.gather(*[async_run_device(device, config_manager, latency_stats, control_server, device_watcher) for device in devices])
+
+
+##########
+# Supervisor
+##########
+# engine=supervisor forks one worker process per device once the config is loaded and compiled, so every worker
+# starts with the compiled config already in (copy-on-write shared) memory and no device waits on another's GIL.
+# Workers log JSON lines to their stdout and send their latency stats on a second pipe, both gathered here.
+# Crashed workers are restarted with backoff, SIGTERM and SIGINT stop every worker so it can release its device.
+# The supervisor process itself runs no threads, so forking it is safe: it writes its log and stats from its own loop.
+worker_unavailable_status = 3 # Exit status of a worker whose device is missing or grabbed by another program, it isn't restarted.
+supervisor_signals = (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD, signal.SIGUSR1)
+class SupervisedWorker():
+    __slots__ = ("device", "pid", "started", "crashes", "restart_at", "attached", "was_attached")
+
+    def __init__(self, device):
+        self.device = device
+        self.pid = None
+        self.started = 0.0
+        self.crashes = 0 # Crashes in a row, the restart backoff doubles with each.
+        self.restart_at = None
+        self.attached = False # Whether the worker's device is attached right now, as last reported on its state pipe.
+        self.was_attached = False # Whether the current worker process ever had its device attached.
+
+def stop_worker(signum, frame):
+    raise SystemExit(0)
+
+def reset_worker_signals():
+    # Replaces the supervisor's signal handlers in a forked worker, before the signals blocked around fork() are let through.
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C reaches the supervisor, which stops the workers with SIGTERM.
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop_worker)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, supervisor_signals)
+
+def run_worker(device, config_manager, stats_fd=None, state_fd=None):
+    # Runs one device in a forked worker, returning its exit status: 0 once the device stopped on its exit key,
+    # worker_unavailable_status if the device can't be used and 1 if it stopped on an error.
+    # Whether the device is attached is reported on state_fd as b"1" or b"0".
+    config_manager.reload()
+    config_manager.watch()
+    key_scheduler = get_key_scheduler(config_manager.get().config)
+    process_runner = ProcessRunner(key_scheduler.queue_depth)
+    latency_stats = None
+    if stats_fd is not None:
+        stats_out = os.fdopen(stats_fd, "w")
+        stats_lock = Lock()
+        def send_stats(raw):
+            with stats_lock:
                 try:
-                    dev.ungrab()
-                except IOError:
+                    stats_out.write(json.dumps(raw) + "\n")
+                    stats_out.flush()
+                except (OSError, ValueError):
                     pass
-                fake_dev.close()
-        except IOError:
-            print(invalid_dev_msg)
-            pass
-    else:
-        print(dev_no_config_msg)
+        latency_stats = LatencyStats(None)
+        latency_stats.send = send_stats
+        latency_stats.counters["keyboard"] = key_scheduler.stats
+        latency_stats.counters["commands"] = process_runner.stats
+        latency_stats.start()
+    device_watcher = DeviceWatcher()
+    if not device_watcher.start():
+        device_watcher = None
+    elif state_fd is not None:
+        def send_state(attached):
+            try:
+                os.write(state_fd, b"1" if attached > 0 else b"0")
+            except OSError:
+                pass
+        device_watcher.attached_listener = send_state
+    try:
+        stopped = run_device(device, config_manager, key_scheduler, process_runner, latency_stats, None, device_watcher)
+        process_runner.wait()
+    finally:
+        if latency_stats is not None:
+            latency_stats.write()
+    if stopped is None:
+        return worker_unavailable_status
+    return 0 if stopped else 1
 
+class Supervisor():
+    def __init__(self, devices, config_manager, latency_stats=None):
+        self.config_manager = config_manager
+        self.latency_stats = latency_stats
+        self.workers = [SupervisedWorker(device) for device in devices]
+        self.running = {} # pid -> SupervisedWorker
+        self.selector = selectors.DefaultSelector()
+        self.stop_requested = False
+        self.stopping = False
+        self.stop_deadline = None
+        self.stats_requested = False
 
-def run_devices(config_file):
-    for device in read_config(config_file).get(devices_tag, {}).keys():
+    def start_worker(self, worker):
+        log_read, log_write = os.pipe()
+        state_read, state_write = os.pipe()
+        stats_read, stats_write = os.pipe() if self.latency_stats is not None else (None, None)
+        sys.stdout.flush()
+        # Signals wait until the worker has replaced the supervisor's handlers, which would only set flags in its copy of self.
+        signal.pthread_sigmask(signal.SIG_BLOCK, supervisor_signals)
         try:
-            run_thread(run_device, (device, config_file,))
-        except Exception as error:
-            print(gen_log_msg(device, "", f"Failed to start, skipping...: {str(error)}"))
-            pass
+            pid = os.fork()
+        except OSError:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, supervisor_signals)
+            raise
+        if pid == 0:
+            status = 1
+            try:
+                reset_worker_signals()
+                for key in list(self.selector.get_map().values()):
+                    os.close(key.fd)
+                self.selector.close()
+                os.close(log_read)
+                os.close(state_read)
+                if stats_read is not None:
+                    os.close(stats_read)
+                os.dup2(log_write, 1)
+                os.close(log_write)
+                sys.stdout = open(1, "w", closefd=False) # The supervisor's stdout buffer may hold its unwritten output.
+                logger.json_lines = True
+                status = run_worker(worker.device, self.config_manager, stats_write, state_write)
+            except SystemExit as error:
+                status = error.code if isinstance(error.code, int) else 0
+            except BaseException as error:
+                log(log_error, worker.device, "", f"Worker hit a critical error, stopping...: {str(error)}")
+            finally:
+                # Never return into the supervisor's code, whatever happens.
+                signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                try:
+                    logger.close()
+                finally:
+                    os._exit(status)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, supervisor_signals)
+        os.close(log_write)
+        os.close(state_write)
+        self.selector.register(log_read, selectors.EVENT_READ, (worker, pid, False, [b""]))
+        self.selector.register(state_read, selectors.EVENT_READ, worker)
+        if stats_read is not None:
+            os.close(stats_write)
+            self.selector.register(stats_read, selectors.EVENT_READ, (worker, pid, True, [b""]))
+        worker.pid = pid
+        worker.started = monotonic()
+        worker.restart_at = None
+        worker.attached = False
+        worker.was_attached = False
+        self.running[pid] = worker
+
+    def read_state(self, key):
+        worker = key.data
+        try:
+            data = os.read(key.fd, 4096)
+        except OSError:
+            data = b""
+        if len(data) > 0:
+            worker.attached = data[-1:] == b"1"
+            worker.was_attached = worker.was_attached or worker.attached
+        else:
+            self.selector.unregister(key.fd)
+            os.close(key.fd)
+            worker.attached = False
+
+    def read_pipe(self, key):
+        worker, pid, is_stats, buffer = key.data
+        try:
+            data = os.read(key.fd, 64 * 1024)
+        except OSError:
+            data = b""
+        if len(data) > 0:
+            *lines, buffer[0] = (buffer[0] + data).split(b"\n")
+        else:
+            lines = [buffer[0]]
+            self.selector.unregister(key.fd)
+            os.close(key.fd)
+        for line in lines:
+            if len(line.strip()) == 0:
+                continue
+            try:
+                record = json.loads(line)
+            except (JSONDecodeError, UnicodeDecodeError):
+                record = None
+            if is_stats:
+                if isinstance(record, dict):
+                    # Kept per worker process, so the stats of a crashed worker still count after its restart.
+                    self.latency_stats.set_source(pid, record)
+            elif isinstance(record, dict):
+                log(log_levels.get(record.get("level", None), log_info), record.get("device", ""), record.get("layer", ""), record.get("msg", ""))
+            else:
+                log(log_info, worker.device, "", line.decode("utf-8", "replace"))
+
+    def reap(self):
+        quit = False
+        while len(self.running) > 0:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            worker = self.running.pop(pid, None)
+            if worker is None:
+                continue
+            worker.pid = None
+            exit_code = os.waitstatus_to_exitcode(status)
+            if exit_code == 0 and worker.was_attached:
+                quit = True
+            if exit_code == 0 or self.stopping:
+                continue
+            if exit_code == worker_unavailable_status:
+                # Restarting won't help, the worker already waits for devices to be plugged in when it can watch for them.
+                log(log_warning, worker.device, "", "Device is missing or grabbed by another program, not restarting its worker.")
+                continue
+            if monotonic() - worker.started >= supervisor_stable_time_def:
+                worker.crashes = 0
+            backoff = min(supervisor_backoff_max_def, supervisor_backoff_min_def * 2 ** worker.crashes)
+            worker.crashes += 1
+            worker.restart_at = monotonic() + backoff
+            log(log_warning, worker.device, "", f"Worker exited with [ {exit_code} ], restarting it in [ {backoff} ] seconds...")
+        # Like in the other engines, once the last attached device stopped on its exit key the devices still waiting to be plugged in stop too.
+        if quit and not self.stopping and len(self.running) > 0 and not any(worker.attached for worker in self.running.values()) and not any(worker.restart_at is not None for worker in self.workers):
+            log(log_info, msg="Every attached device has stopped, no longer waiting for the others.")
+            self.stop()
+
+    def stop(self):
+        self.stopping = True
+        self.stop_deadline = monotonic() + supervisor_stop_timeout_def
+        for worker in self.workers:
+            worker.restart_at = None
+        for pid in self.running:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        # Returns once every worker has stopped on its exit key, or after a stop signal once they all exited.
+        wake_read, wake_write = os.pipe()
+        os.set_blocking(wake_read, False)
+        os.set_blocking(wake_write, False)
+        self.selector.register(wake_read, selectors.EVENT_READ, None)
+        def handle_signal(signum, frame):
+            # Only flags the stop (or stats write), the loop below is woken through the wakeup fd.
+            if signum == signal.SIGUSR1:
+                self.stats_requested = True
+            elif signum != signal.SIGCHLD:
+                self.stop_requested = True
+        previous_wakeup_fd = signal.set_wakeup_fd(wake_write)
+        previous_handlers = {signum: signal.signal(signum, handle_signal) for signum in supervisor_signals}
+        stats_at = monotonic() + self.latency_stats.interval if self.latency_stats is not None else None
+        try:
+            for worker in self.workers:
+                self.start_worker(worker)
+            while len(self.running) > 0 or len(self.selector.get_map()) > 1 or any(worker.restart_at is not None for worker in self.workers):
+                if self.stop_requested and not self.stopping:
+                    log(log_info, msg="Stopping workers...")
+                    self.stop()
+                now = monotonic()
+                deadlines = [worker.restart_at for worker in self.workers if worker.restart_at is not None]
+                if self.stop_deadline is not None:
+                    deadlines.append(self.stop_deadline)
+                if stats_at is not None:
+                    deadlines.append(stats_at)
+                timeout = max(0.0, min(deadlines) - now) if len(deadlines) > 0 else None
+                for key, events in self.selector.select(timeout):
+                    if key.data is None:
+                        try:
+                            os.read(wake_read, 4096)
+                        except BlockingIOError:
+                            pass
+                    elif isinstance(key.data, SupervisedWorker):
+                        self.read_state(key)
+                    else:
+                        self.read_pipe(key)
+                self.reap()
+                now = monotonic()
+                if self.stop_deadline is not None and now >= self.stop_deadline:
+                    for pid, worker in self.running.items():
+                        log(log_warning, worker.device, "", "Worker didn't stop in time, killing it...")
+                        try:
+                            os.kill(pid, signal.SIGKILL)
+                        except ProcessLookupError:
+                            pass
+                    self.stop_deadline = None
+                if stats_at is not None and (now >= stats_at or self.stats_requested):
+                    self.latency_stats.write()
+                    self.stats_requested = False
+                    stats_at = now + self.latency_stats.interval
+                for worker in self.workers:
+                    if worker.restart_at is not None and now >= worker.restart_at:
+                        log(log_info, worker.device, "", "Restarting worker...")
+                        self.start_worker(worker)
+        finally:
+            signal.set_wakeup_fd(previous_wakeup_fd)
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+            self.selector.unregister(wake_read)
+            os.close(wake_read)
+            os.close(wake_write)
+
+
+def run_devices(config_file, engine=engine_def, stats_file=None, socket_file=control_socket_def):
+    # Latency stats are only collected when a stats_file is given, the control socket only listens when a socket_file is.
+    if engine == engine_supervisor_tag:
+        logger.set_threaded(False) # See Supervisor, it forks workers at any time so it must not start threads.
+    import_evdev()
+    config_manager = ConfigManager(config_file)
+    try:
+        config_manager.load()
+    except ConfigError as error:
+        log(log_error, msg=f"{str(error)}, stopping...")
+        return
+    devices = list(config_manager.get().devices.keys())
+    latency_stats = None
+    if stats_file is not None:
+        latency_stats = LatencyStats(stats_file)
+        if engine != engine_supervisor_tag:
+            latency_stats.start()
+    if engine == engine_supervisor_tag:
+        # Workers watch the config themselves. The control socket needs every dispatcher in this process, so it's off.
+        Supervisor(devices, config_manager, latency_stats).run()
+        if latency_stats is not None:
+            latency_stats.write()
+        return
+    config_manager.watch()
+    device_watcher = DeviceWatcher()
+    if not device_watcher.start():
+        device_watcher = None
+    control_server = None
+    if socket_file is not None:
+        control_server = ControlServer(socket_file, config_manager, latency_stats)
+        if not control_server.start():
+            control_server = None
+    try:
+        if engine == engine_async_tag:
+            asyncio.run(async_run_devices(devices, config_manager, latency_stats, control_server, device_watcher))
+            if latency_stats is not None:
+                latency_stats.write()
+            return
+        key_scheduler = get_key_scheduler(config_manager.get().config)
+        process_runner = ProcessRunner(key_scheduler.queue_depth)
+        if latency_stats is not None:
+            latency_stats.counters["keyboard"] = key_scheduler.stats
+            latency_stats.counters["commands"] = process_runner.stats
+        if control_server is not None:
+            control_server.counters["keyboard"] = key_scheduler.stats
+            control_server.counters["commands"] = process_runner.stats
+        threads = []
+        for device in devices:
+            try:
+                threads.append(run_thread(run_device, (device, config_manager, key_scheduler, process_runner, latency_stats, control_server, device_watcher,)))
+            except Exception as error:
+                log(log_error, device, "", f"Failed to start, skipping...: {str(error)}")
+                pass
+        for thread in threads:
+            thread.join()
+        process_runner.wait()
+        if latency_stats is not None:
+            latency_stats.write()
+        key_stats = key_scheduler.stats()
+        if key_stats["dropped"] > 0 or key_stats["coalesced"] > 0:
+            log(log_warning, msg=f"Keyboard actions dropped: [ {key_stats['dropped']} ], coalesced: [ {key_stats['coalesced']} ] because the action queue was full.")
+        command_stats = process_runner.stats()
+        if command_stats["dropped"] > 0:
+            log(log_warning, msg=f"Commands dropped: [ {command_stats['dropped']} ] because their device already had [ {process_runner.queue_depth} ] running.")
+    finally:
+        if control_server is not None:
+            control_server.stop()
+
+
+##########
+# Benchmarks
+##########
+# Replays synthetic or recorded event traces through DeviceDispatcher with nothing but evdev installed:
+# no input device is grabbed, no uinput device is created and no command is run.
+bench_device = "bench_device"
+bench_sizes_def = (10, 100, 1000, 10000) # Default numbers of keybinds in the generated benchmark configs.
+bench_events_def = 20000 # Default number of events per benchmark trace.
+bench_inherit_depth_def = 32 # Layers in the inheritance chain of the deep inheritance benchmark.
+bench_alias_depth_def = 16 # Aliases in each alias chain of the alias benchmark.
+
+class RecordingActions():
+    # An action backend that only records what would have run, in place of ThreadActions/AsyncActions.
+    # Recorded actions count as finished right away.
+    def __init__(self):
+        self.actions = []
+
+    def run_shell(self, cmd, device="", current_layer="", print_output=True, trace=None, done=None):
+        self.actions.append((action_shell_tag, cmd))
+        if done is not None:
+            done()
+
+    def run_exec(self, argv, device="", current_layer="", print_output=True, trace=None, done=None):
+        self.actions.append((action_exec_tag, argv))
+        if done is not None:
+            done()
+
+    def run_keys(self, keys, trace=None, done=None):
+        self.actions.append((action_keyboard_tag, keys))
+        if done is not None:
+            done()
+
+def get_bench_keys():
+    exit_codes = {get_key_code(exit_key_def), get_key_code(universal_exit_key)}
+    return sorted(name for name, code in ecodes.ecodes.items() if name.startswith("KEY_") and code not in exit_codes and ecodes.KEY.get(code, None) is not None)
+
+def gen_bench_config(binds, inherit_depth=1, alias_depth=1):
+    # Spreads binds over as many layers as needed, each layer inheriting the one before it.
+    # Every tenth bind switches layers, every tenth is a keyboard action and every tenth an alias chain.
+    keys = get_bench_keys()
+    layer_count = max(inherit_depth, -(-binds // len(keys)))
+    layers = {}
+    for index in range(layer_count):
+        layers[f"layer_{index}"] = {keybinds_tag: {}}
+        if index > 0:
+            layers[f"layer_{index}"][inherit_tag] = f"layer_{index - 1}"
+    aliases = {f"alias_{index}": {action_type_tag: action_alias_tag, action_tag: f"alias_{index + 1}"} for index in range(alias_depth - 1)}
+    aliases[f"alias_{alias_depth - 1}"] = {action_type_tag: action_shell_tag, action_tag: "true"}
+    for index in range(binds):
+        layer = f"layer_{index % layer_count}"
+        key = keys[(index // layer_count) % len(keys)]
+        if index % 10 == 3:
+            bind = {action_type_tag: action_set_layer_tag, action_tag: f"layer_{(index * 7) % layer_count}"}
+        elif index % 10 == 5:
+            bind = {action_type_tag: action_keyboard_tag, action_tag: [{key_tag: key, hold_time_tag: 0.01}, {key_tag: key, set_key_tag: 0}]}
+        elif index % 10 == 7:
+            bind = {action_type_tag: action_multi_tag, action_tag: [{action_type_tag: action_alias_tag, action_tag: "alias_0"}, {action_type_tag: action_exec_tag, action_tag: ["true"]}]}
+        else:
+            bind = {action_type_tag: action_shell_tag, action_tag: f"echo {index}"}
+        layers[layer][keybinds_tag][key] = bind
+    return {
+        devices_tag: {
+            bench_device: {
+                device_nickname_tag: "bench",
+                exit_key_tag: exit_key_def,
+                first_layer_tag: f"layer_{layer_count - 1}",
+                log_level_tag: "warning",
+                aliases_tag: aliases,
+                layers_tag: layers
+            }
+        }
+    }
+
+def gen_bench_trace(scenario, config, events=bench_events_def, seed=0):
+    # Returns a list of InputEvents for one of the scenarios burst, held, layers, deep and alias.
+    from evdev import InputEvent
+    device_config = config[devices_tag][bench_device]
+    layers = device_config[layers_tag]
+    randomizer = random.Random(seed)
+    if scenario == "layers":
+        codes = [get_key_code(key) for layer in layers.values() for key, bind in layer[keybinds_tag].items() if bind[action_type_tag] == action_set_layer_tag]
+    elif scenario == "alias":
+        codes = [get_key_code(key) for layer in layers.values() for key, bind in layer[keybinds_tag].items() if bind[action_type_tag] == action_multi_tag]
+    elif scenario == "deep":
+        # Keys only bound at the bottom of the inheritance chain.
+        codes = [get_key_code(key) for key in layers["layer_0"][keybinds_tag]]
+    else:
+        codes = [get_key_code(key) for layer in layers.values() for key in layer[keybinds_tag]]
+    codes = codes or [get_key_code(get_bench_keys()[0])]
+    trace = []
+    now = time()
+    while len(trace) < events:
+        code = randomizer.choice(codes)
+        repeats = 30 if scenario == "held" else 0
+        for value in [1] + [2] * repeats + [0]:
+            trace.append(InputEvent(int(now), int(now * 1000000) % 1000000, ecodes.EV_KEY, code, value))
+            trace.append(InputEvent(int(now), int(now * 1000000) % 1000000, ecodes.EV_SYN, ecodes.SYN_REPORT, 0))
+            now += 0.0005
+    return trace[:events]
+
+def read_bench_trace(trace_file):
+    # A recorded trace is a JSON list of [sec, usec, type, code, value] events.
+    from evdev import InputEvent
+    with open(trace_file) as f:
+        return [InputEvent(*event) for event in json.load(f)]
+
+def run_bench_trace(config, trace):
+    # Returns events per second, sorted per-event dispatch times in nanoseconds, and (peak, retained) bytes
+    # allocated while replaying the trace once more under tracemalloc. Retained bytes include the recorded actions.
+    import tracemalloc
+    config_manager = ConfigManager()
+    config_manager.set_config(config)
+    def new_dispatcher():
+        dispatcher = DeviceDispatcher(bench_device, config_manager, RecordingActions())
+        dispatcher.compiled_device[exit_codes_tag] # Fail early if the config didn't compile.
+        return dispatcher
+    dispatcher = new_dispatcher()
+    handle_event = dispatcher.handle_event
+    times = []
+    started = perf_counter_ns()
+    for event in trace:
+        event_started = perf_counter_ns()
+        handle_event(event)
+        times.append(perf_counter_ns() - event_started)
+    elapsed = perf_counter_ns() - started
+    dispatcher = new_dispatcher()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    for event in trace:
+        dispatcher.handle_event(event)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    times.sort()
+    return len(trace) * 1000000000 / max(elapsed, 1), times, (peak, retained)
+
+def print_bench_result(name, binds, compile_time, result):
+    events_per_second, times, (peak, retained) = result
+    def percentile(fraction):
+        return times[min(len(times) - 1, int(fraction * len(times)))] / 1000
+    print(f"{name:<8} binds {binds:>6} | compile {compile_time / 1000000:9.2f} ms | {events_per_second:>10.0f} events/s | p50 {percentile(0.5):7.2f} us | p99 {percentile(0.99):7.2f} us | max {times[-1] / 1000:8.2f} us | alloc peak {peak / 1024:8.1f} KiB, retained {retained / 1024:8.1f} KiB")
+
+def run_bench(sizes=bench_sizes_def, events=bench_events_def, trace_file=None):
+    import_evdev()
+    if trace_file is not None:
+        trace = read_bench_trace(trace_file)
+    for binds in sizes:
+        for scenario in ("burst", "held", "layers", "deep", "alias"):
+            if trace_file is not None and scenario != "burst":
+                continue
+            config = gen_bench_config(binds, bench_inherit_depth_def if scenario == "deep" else 1, bench_alias_depth_def if scenario == "alias" else 1)
+            started = perf_counter_ns()
+            compile_devices(config)
+            compile_time = perf_counter_ns() - started
+            if trace_file is None:
+                trace = gen_bench_trace(scenario, config, events)
+            print_bench_result("trace" if trace_file is not None else scenario, binds, compile_time, run_bench_trace(config, trace))
 
 
 def main_run(args):
     config_file = config_file_def
+    engine = engine_def
+    stats_file = None
+    log_level = log_level_def
+    log_format = log_format_def
+    socket_file = control_socket_def
     if len(args) > 1:
         invalid_cmdline_msg = "Invalid command line arguments!"
         usage_msg = """
@@ -421,13 +2987,27 @@ Usage:
 
 Run normally: python keysboard.py
 Add device: python keysboard.py add-device device_name
-Add layer to device: python keysboard.py add-device device_name layer_name
+Add layer to device: python keysboard.py add-layer device_name layer_name
 Add keybind to layer of device: python keysboard.py add-keybind device_name layer_name keycode action_type \"action\"
+Remove keybind from layer of device: python keysboard.py remove-keybind device_name layer_name keycode
+Import many keybinds at once: python keysboard.py import-keybinds path/to/keybinds.json (or .csv with the columns device,layer,key,action_type,action)
+Record a macro from a device: python keysboard.py record device_name path/to/macro.kbm [stop=KEY_ESC] (press the stop key to finish)
+(While keysboard is running, the add and remove commands go through its control socket and take effect right away.)
+
+List running devices and their layers: python keysboard.py list-devices
+Switch the layer of a running device: python keysboard.py set-layer device_name_or_nickname layer_name
+Reload the config of a running keysboard: python keysboard.py reload
 
 Run with different config: python keysboard.py command options config=path/to/config.json
+Run with a different engine: python keysboard.py engine=async (valid engines: threaded, async, supervisor)
+Run with latency stats: python keysboard.py stats=path/to/stats.json (written every few seconds and on SIGUSR1)
+Run with different logging: python keysboard.py log_level=info log_format=json (levels: debug, info, warning, error, off, formats: text, json)
+Run with a different control socket: python keysboard.py socket=path/to/keysboard.sock (or socket=off to disable it)
+Show latency stats: python keysboard.py show-stats [stats=path/to/stats.json] (live from keysboard if it is running)
+Benchmark dispatching without any devices: python keysboard.py bench [sizes=10,1000,...] [events=20000] [trace=path/to/trace.json]
 
-Valid action_type values: shell, set_layer
-Valid action values (respectively): any shell command, any layer of same device
+Valid action_type values: shell, exec, set_layer, macro
+Valid action values (respectively): any shell command, any command to run without a shell, any layer of same device, a recorded macro file (relative to the config)
 
 Requires python 3!
         """
@@ -436,35 +3016,136 @@ Requires python 3!
                 print(invalid_cmdline_msg)
             print(usage_msg)
         config_arg = "config="
-        for arg in args:
+        engine_arg = "engine="
+        stats_arg = "stats="
+        log_level_arg = "log_level="
+        log_format_arg = "log_format="
+        socket_arg = "socket="
+        for arg in list(args):
             if arg.startswith(config_arg):
                 config_file = os.path.expanduser(arg.replace(config_arg, ""))
                 args.remove(arg)
+            elif arg.startswith(engine_arg):
+                engine = arg.replace(engine_arg, "")
+                args.remove(arg)
+            elif arg.startswith(stats_arg):
+                stats_file = os.path.expanduser(arg.replace(stats_arg, ""))
+                args.remove(arg)
+            elif arg.startswith(log_level_arg):
+                log_level = arg.replace(log_level_arg, "")
+                args.remove(arg)
+            elif arg.startswith(log_format_arg):
+                log_format = arg.replace(log_format_arg, "")
+                args.remove(arg)
+            elif arg.startswith(socket_arg):
+                socket_file = os.path.expanduser(arg.replace(socket_arg, ""))
+                args.remove(arg)
+        if socket_file == control_off_tag:
+            socket_file = None
+        if engine not in (engine_threaded_tag, engine_async_tag, engine_supervisor_tag) or log_level not in log_levels or log_format not in (log_format_text_tag, log_format_json_tag):
+            print_usage_msg(True)
+            return
+        logger.level = log_levels[log_level]
+        logger.json_lines = log_format == log_format_json_tag
         if len(args) > 1:
             if "help" in args or "h" in args:
                 print(usage_msg)
             elif "add-device" in args:
                 if len(args) >= 3:
-                    add_device(args[2])
+                    if not send_control_edit({control_command_tag: "add_device", "device": args[2]}, config_file, socket_file):
+                        add_device(args[2], config_file)
                 else:
                     print_usage_msg(True)
             elif "add-layer" in args:
                 if len(args) >= 4:
-                    add_layer(args[2], args[3])
+                    if not send_control_edit({control_command_tag: "add_layer", "device": args[2], "layer": args[3]}, config_file, socket_file):
+                        add_layer(args[2], args[3], config_file)
                 else:
                     print_usage_msg(True)
             elif "add-keybind" in args:
                 if len(args) >= 7:
-                    add_keybind(args[2], args[3], args[4], args[5], args[6])
+                    if not send_control_edit({control_command_tag: "add_keybind", "device": args[2], "layer": args[3], key_tag: args[4], action_type_tag: args[5], action_tag: args[6]}, config_file, socket_file):
+                        add_keybind(args[2], args[3], args[4], args[5], args[6], config_file)
+                else:
+                    print_usage_msg(True)
+            elif "remove-keybind" in args:
+                if len(args) >= 5:
+                    if not send_control_edit({control_command_tag: "remove_keybind", "device": args[2], "layer": args[3], key_tag: args[4]}, config_file, socket_file):
+                        remove_keybind(args[2], args[3], args[4], config_file)
+                else:
+                    print_usage_msg(True)
+            elif "list-devices" in args or "set-layer" in args or "reload" in args:
+                if "set-layer" in args and len(args) < 4:
+                    print_usage_msg(True)
+                    return
+                if "list-devices" in args:
+                    request = {control_command_tag: "devices"}
+                elif "set-layer" in args:
+                    request = {control_command_tag: "set_layer", "device": args[2], "layer": args[3]}
+                else:
+                    request = {control_command_tag: "reload"}
+                response = send_control(request, socket_file) if socket_file is not None else None
+                if response is None:
+                    print(f"keysboard is not running (no answer on [ {socket_file} ]).")
+                elif not response.get(control_ok_tag, False):
+                    print(f"keysboard could not do that: {response.get(control_error_tag, '')}")
+                elif "reloaded" in response:
+                    print("Config reloaded." if response["reloaded"] else "The config could not be reloaded, see the keysboard log.")
+                elif devices_tag in response:
+                    for device, info in response[devices_tag].items():
+                        print(f"[ {info[device_nickname_tag] or device} ] ( {device} ) layer: [ {info['layer'] if info['layer'] is not None else 'not running'} ], layers: {', '.join(info[layers_tag])}")
+            elif "show-stats" in args:
+                response = send_control({control_command_tag: "stats"}, socket_file) if socket_file is not None and stats_file is None else None
+                if response is not None and response.get(control_ok_tag, False):
+                    print_stats_dump(response["stats"])
+                else:
+                    try:
+                        print_stats(stats_file or stats_file_def)
+                    except (OSError, ValueError) as error:
+                        print(f"Could not read latency stats from [ {stats_file or stats_file_def} ]: {str(error)}")
+            elif "bench" in args:
+                bench_options = dict(arg.split("=", 1) for arg in args[2:] if "=" in arg)
+                try:
+                    sizes = tuple(int(size) for size in bench_options["sizes"].split(",")) if "sizes" in bench_options else bench_sizes_def
+                    events = int(bench_options.get("events", bench_events_def))
+                except ValueError:
+                    print_usage_msg(True)
+                else:
+                    run_bench(sizes, events, bench_options.get("trace", None))
+            elif "import-keybinds" in args:
+                if len(args) >= 3:
+                    try:
+                        print(f"Imported [ {import_keybinds(os.path.expanduser(args[2]), config_file)} ] keybinds.")
+                    except (OSError, ValueError, csv.Error) as error:
+                        print(f"Could not import keybinds from [ {args[2]} ]: {str(error)}")
+                else:
+                    print_usage_msg(True)
+            elif "record" in args:
+                record_options = dict(arg.split("=", 1) for arg in args[2:] if "=" in arg)
+                record_args = [arg for arg in args[2:] if "=" not in arg]
+                if len(record_args) >= 2:
+                    import_evdev()
+                    stop_key = record_options.get("stop", record_stop_key_def)
+                    if get_key_code(stop_key) is None:
+                        print(f"Unknown stop key [ {stop_key} ]")
+                        return
+                    print(f"Recording [ {record_args[0]} ], press [ {stop_key} ] to stop...")
+                    try:
+                        print(f"Recorded [ {record_macro(record_args[0], os.path.expanduser(record_args[1]), stop_key)} ] key events to [ {record_args[1]} ].")
+                    except OSError as error:
+                        print(f"Could not record from [ {record_args[0]} ]: {str(error)}")
                 else:
                     print_usage_msg(True)
             else:
                 print_usage_msg(True)
         else:
-            run_devices(config_file)
+            run_devices(config_file, engine, stats_file, socket_file)
     else:
-        run_devices(config_file)
+        run_devices(config_file, engine, stats_file, socket_file)
 
 
 if __name__ == "__main__":
-    main_run(sys.argv)
+    try:
+        main_run(sys.argv)
+    finally:
+        logger.close()
@@ -0,0 +1,41 @@
+import os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import keysboard
+
+
+@pytest.fixture(autouse=True)
+def evdev_codes():
+    # Compiling configs needs evdev's key codes, nothing here opens a device or creates a uinput device.
+    pytest.importorskip("evdev")
+    keysboard.import_evdev()
+
+
+@pytest.fixture
+def logged(monkeypatch):
+    # Collects (level, device, layer, msg) instead of writing log records.
+    records = []
+    monkeypatch.setattr(keysboard, "log", lambda level, device="", current_layer="", msg="", coalesce=False: records.append((level, device, current_layer, msg)))
+    return records
+
+
+class RecordingOutput():
+    # Stands in for a uinput device, recording each SYN report as the list of (code, state) written before it.
+    def __init__(self, reports=None):
+        self.reports = reports if reports is not None else []
+        self.pending = []
+
+    def write(self, event_type, code, value):
+        self.pending.append((code, value))
+
+    def syn(self):
+        self.reports.append(self.pending)
+        self.pending = []
+
+
+@pytest.fixture
+def output():
+    return RecordingOutput()
@@ -0,0 +1,32 @@
+import json
+
+import pytest
+
+import keysboard
+
+
+@pytest.mark.parametrize("scenario, inherit_depth, alias_depth", [("burst", 1, 1), ("held", 1, 1), ("layers", 1, 1), ("deep", 4, 1), ("alias", 1, 4)])
+def test_bench_traces_replay_through_the_dispatcher(scenario, inherit_depth, alias_depth):
+    config = keysboard.gen_bench_config(50, inherit_depth, alias_depth)
+    compiled_device = keysboard.compile_devices(config)[keysboard.bench_device]
+    assert compiled_device[keysboard.compile_warnings_tag] == ()
+    assert len(compiled_device[keysboard.keymaps_tag]) >= inherit_depth
+    trace = keysboard.gen_bench_trace(scenario, config, 200)
+    assert len(trace) == 200
+    events_per_second, times, (peak, retained) = keysboard.run_bench_trace(config, trace)
+    assert events_per_second > 0
+    assert len(times) == 200 and times == sorted(times)
+    assert peak >= retained >= 0
+
+def test_recorded_traces_are_read_back(tmp_path):
+    config = keysboard.gen_bench_config(10)
+    trace = keysboard.gen_bench_trace("burst", config, 20)
+    trace_file = tmp_path / "trace.json"
+    trace_file.write_text(json.dumps([[event.sec, event.usec, event.type, event.code, event.value] for event in trace]))
+    read_trace = keysboard.read_bench_trace(str(trace_file))
+    assert [(event.type, event.code, event.value) for event in read_trace] == [(event.type, event.code, event.value) for event in trace]
+
+def test_bench_prints_one_line_per_scenario(capsys):
+    keysboard.run_bench((10,), 100)
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split()[0] for line in lines] == ["burst", "held", "layers", "deep", "alias"]
@@ -0,0 +1,140 @@
+import json, os
+
+import pytest
+
+import keysboard
+
+
+def write_config(config_file, layers):
+    with open(config_file, "w") as f:
+        json.dump({keysboard.devices_tag: {"pad": {keysboard.layers_tag: layers}}}, f)
+
+def compile_layers(layers, **device_config):
+    return keysboard.compile_devices({keysboard.devices_tag: {"pad": {keysboard.layers_tag: layers, **device_config}}})["pad"]
+
+def layer(keybinds, inherit=None):
+    layer_config = {keysboard.keybinds_tag: {key: {keysboard.action_tag: action} for key, action in keybinds.items()}}
+    if inherit is not None:
+        layer_config[keysboard.inherit_tag] = inherit
+    return layer_config
+
+def shell(action):
+    return ((keysboard.action_shell_tag, action),)
+
+@pytest.fixture
+def config_manager(tmp_path, monkeypatch):
+    monkeypatch.setattr(keysboard, "config_cache_def", False)
+    config_file = str(tmp_path / "keysboard.json")
+    write_config(config_file, {"main": {keysboard.keybinds_tag: {"KEY_1": {keysboard.action_tag: "true"}}}})
+    config_manager = keysboard.ConfigManager(config_file)
+    config_manager.load()
+    return config_manager
+
+def write_broken(config_manager, content):
+    with open(config_manager.config_file, "w") as f:
+        f.write(content)
+    # Writes within one mtime tick must still look like a change.
+    os.utime(config_manager.config_file, ns=(len(content), len(content)))
+
+
+@pytest.mark.parametrize("config", [[], {keysboard.devices_tag: []}, {keysboard.devices_tag: {"pad": {keysboard.layers_tag: []}}}, {keysboard.devices_tag: {"pad": {keysboard.layers_tag: {"main": {keysboard.keybinds_tag: []}}}}}])
+def test_configs_of_the_wrong_shape_are_config_errors(config):
+    with pytest.raises(keysboard.ConfigError):
+        keysboard.compile_devices(config)
+
+def test_invalid_reload_keeps_the_last_good_snapshot(config_manager):
+    snapshot = config_manager.get()
+    for broken in ("[]", '{"devices": {"pad": {"layers": {"main": {"keybinds": []}}}}}', '{"devices": {"pad": {"layers": 1}}}', "{"):
+        write_broken(config_manager, broken)
+        assert not config_manager.reload()
+        assert config_manager.get() is snapshot
+
+def test_unexpected_reload_errors_dont_end_the_watcher(config_manager, logged, monkeypatch):
+    snapshot = config_manager.get()
+    compile_devices = keysboard.compile_devices
+    def failing_compile_devices(config, base_dir=None):
+        raise RuntimeError("boom")
+    monkeypatch.setattr(keysboard, "compile_devices", failing_compile_devices)
+    write_broken(config_manager, '{"devices": {}}')
+    config_manager.watch_reload()
+    assert config_manager.get() is snapshot
+    assert [level for level, device, layer, msg in logged] == [keysboard.log_error]
+    # The next edit is still picked up.
+    monkeypatch.setattr(keysboard, "compile_devices", compile_devices)
+    config_manager.watch_reload()
+    assert config_manager.get().devices == {}
+
+def test_layers_inherit_in_order_and_override():
+    keymaps = compile_layers({
+        "base": layer({"KEY_1": "base 1", "KEY_2": "base 2"}),
+        "media": layer({"KEY_2": "media 2", "KEY_3": "media 3"}),
+        "main": layer({"KEY_3": "main 3"}, ["base", "media"])
+    })[keysboard.keymaps_tag]
+    code = keysboard.get_key_code
+    assert keymaps["main"] == {code("KEY_1"): shell("base 1"), code("KEY_2"): shell("media 2"), code("KEY_3"): shell("main 3")}
+
+@pytest.mark.parametrize("layers", [
+    {"main": layer({}, "main")},
+    {"main": layer({}, ["other"]), "other": layer({}, "third"), "third": layer({}, "main")}
+])
+def test_layer_inheritance_cycles_are_rejected(layers):
+    with pytest.raises(keysboard.ConfigError, match="cycle"):
+        compile_layers(layers)
+
+def test_inherit_entries_that_arent_layer_names_are_ignored():
+    compiled_device = compile_layers({"base": layer({"KEY_1": "base"}), "main": layer({}, [["base"], {"layer": "base"}, 1, "base", "missing"])})
+    assert compiled_device[keysboard.keymaps_tag]["main"] == {keysboard.get_key_code("KEY_1"): shell("base")}
+    assert [msg for device, current_layer, msg in compiled_device[keysboard.compile_warnings_tag]] == ["Inherited layer [ missing ] is not in config, ignoring..."]
+
+def test_aliases_and_multi_actions_compile_to_flat_plans():
+    keymaps = compile_layers({"main": {keysboard.keybinds_tag: {"KEY_1": {keysboard.action_type_tag: keysboard.action_multi_tag, keysboard.action_tag: [
+        {keysboard.action_type_tag: keysboard.action_alias_tag, keysboard.action_tag: "both"},
+        {keysboard.action_type_tag: keysboard.action_set_layer_tag, keysboard.action_tag: "main"}
+    ]}}}}, **{keysboard.aliases_tag: {
+        "both": {keysboard.action_type_tag: keysboard.action_multi_tag, keysboard.action_tag: [{keysboard.action_type_tag: keysboard.action_alias_tag, keysboard.action_tag: "one"}, {keysboard.action_tag: "two"}]},
+        "one": {keysboard.action_tag: "one"}
+    }})[keysboard.keymaps_tag]
+    assert keymaps["main"][keysboard.get_key_code("KEY_1")] == ((keysboard.action_shell_tag, "one"), (keysboard.action_shell_tag, "two"), (keysboard.action_set_layer_tag, "main"))
+
+@pytest.mark.parametrize("aliases", [
+    {"loop": {keysboard.action_type_tag: keysboard.action_alias_tag, keysboard.action_tag: "loop"}},
+    {"ping": {keysboard.action_type_tag: keysboard.action_alias_tag, keysboard.action_tag: "pong"}, "pong": {keysboard.action_type_tag: keysboard.action_multi_tag, keysboard.action_tag: [{keysboard.action_type_tag: keysboard.action_alias_tag, keysboard.action_tag: "ping"}]}}
+])
+def test_recursive_aliases_are_rejected(aliases):
+    keybinds = {"KEY_1": {keysboard.action_type_tag: keysboard.action_alias_tag, keysboard.action_tag: next(iter(aliases))}}
+    with pytest.raises(keysboard.ConfigError, match="recursive"):
+        compile_layers({"main": {keysboard.keybinds_tag: keybinds}}, **{keysboard.aliases_tag: aliases})
+
+@pytest.mark.parametrize("action_type", [keysboard.action_set_layer_tag, keysboard.action_alias_tag])
+@pytest.mark.parametrize("action", [["main"], {"layer": "main"}])
+def test_layer_and_alias_names_must_be_strings(action_type, action):
+    keybinds = {"KEY_1": {keysboard.action_type_tag: action_type, keysboard.action_tag: action}}
+    with pytest.raises(keysboard.ConfigError):
+        compile_layers({"main": {keysboard.keybinds_tag: keybinds}}, **{keysboard.aliases_tag: {"main": {keysboard.action_tag: "true"}}})
+
+@pytest.mark.parametrize("action, argv", [("notify-send 'hi there'", ("notify-send", "hi there")), (["echo", "a b"], ("echo", "a b"))])
+def test_exec_actions_compile_to_argv(action, argv):
+    keybinds = {"KEY_1": {keysboard.action_type_tag: keysboard.action_exec_tag, keysboard.action_tag: action}}
+    keymaps = compile_layers({"main": {keysboard.keybinds_tag: keybinds}})[keysboard.keymaps_tag]
+    assert keymaps["main"][keysboard.get_key_code("KEY_1")] == ((keysboard.action_exec_tag, argv),)
+
+@pytest.mark.parametrize("action", ["echo 'hi", "", [], ["echo", 1]])
+def test_invalid_exec_actions_are_config_errors(action):
+    keybinds = {"KEY_1": {keysboard.action_type_tag: keysboard.action_exec_tag, keysboard.action_tag: action}}
+    with pytest.raises(keysboard.ConfigError):
+        compile_layers({"main": {keysboard.keybinds_tag: keybinds}})
+
+@pytest.mark.parametrize("log_level, expected", [("error", keysboard.log_error), ("loud", keysboard.log_levels[keysboard.log_level_def]), (["error"], keysboard.log_levels[keysboard.log_level_def]), ({}, keysboard.log_levels[keysboard.log_level_def])])
+def test_device_log_levels(log_level, expected):
+    compiled_device = compile_layers({}, **{keysboard.log_level_tag: log_level})
+    assert compiled_device[keysboard.log_level_tag] == expected
+    assert len(compiled_device[keysboard.compile_warnings_tag]) == (0 if expected == keysboard.log_error else 1)
+
+def test_quiet_devices_filter_their_messages(monkeypatch):
+    monkeypatch.setattr(keysboard.logger, "level", keysboard.log_debug)
+    config_manager = keysboard.ConfigManager()
+    config_manager.set_config({keysboard.devices_tag: {"pad": {keysboard.layers_tag: {}, keysboard.log_level_tag: "error", keysboard.device_nickname_tag: "quiet"}}})
+    assert not keysboard.logger.enabled(keysboard.log_warning, "quiet")
+    assert not keysboard.logger.enabled(keysboard.log_warning, "pad")
+    assert keysboard.logger.enabled(keysboard.log_error, "quiet")
+    assert keysboard.logger.enabled(keysboard.log_warning, "another device")
@@ -0,0 +1,109 @@
+import json, os
+
+import pytest
+
+import keysboard
+
+
+def write_config(config_file, exit_key="KEY_Q", hold_time=None):
+    key = {keysboard.key_tag: "KEY_A"}
+    if hold_time is not None:
+        key[keysboard.hold_time_tag] = hold_time
+    config = {keysboard.devices_tag: {"pad": {
+        keysboard.exit_key_tag: exit_key,
+        keysboard.layers_tag: {"main": {keysboard.keybinds_tag: {
+            "KEY_1": {keysboard.action_type_tag: keysboard.action_keyboard_tag, keysboard.action_tag: key},
+            "KEY_NOT_A_KEY": {keysboard.action_tag: "true"}
+        }}}
+    }}}
+    with open(config_file, "w") as f:
+        json.dump(config, f)
+
+def load(config_file):
+    config_manager = keysboard.ConfigManager(str(config_file))
+    config_manager.load()
+    return config_manager.get().devices["pad"]
+
+def hold_time(compiled_device):
+    duration, frames = compiled_device[keysboard.keymaps_tag]["main"][2][0][1]
+    return duration
+
+@pytest.fixture
+def config_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(keysboard, "config_cache_def", True)
+    config_file = tmp_path / "keysboard.json"
+    write_config(config_file)
+    return config_file
+
+@pytest.fixture
+def compiles(monkeypatch):
+    # Counts real compilations, a load served from the cache doesn't compile.
+    calls = []
+    compile_devices = keysboard.compile_devices
+    def counting_compile_devices(*args, **kwargs):
+        calls.append(args)
+        return compile_devices(*args, **kwargs)
+    monkeypatch.setattr(keysboard, "compile_devices", counting_compile_devices)
+    return calls
+
+
+def test_unchanged_config_loads_from_the_cache(config_file, compiles):
+    first = load(config_file)
+    assert os.path.exists(keysboard.get_config_cache_file(str(config_file)))
+    assert load(config_file) == first
+    assert len(compiles) == 1
+
+def test_touched_config_still_matches_by_hash(config_file, compiles):
+    load(config_file)
+    os.utime(config_file, ns=(1, 1))
+    load(config_file)
+    assert len(compiles) == 1
+
+def test_edited_config_is_compiled_again(config_file, compiles):
+    load(config_file)
+    write_config(config_file, hold_time=0.3)
+    os.utime(config_file, ns=(1, 1))
+    assert hold_time(load(config_file)) == 0.3
+    assert len(compiles) == 2
+
+@pytest.mark.parametrize("name, value", [("hold_time_def", 0.5), ("universal_exit_key", "KEY_F12"), ("log_level_def", "error")])
+def test_changed_defaults_invalidate_the_cache(config_file, compiles, monkeypatch, name, value):
+    load(config_file)
+    monkeypatch.setattr(keysboard, name, value)
+    compiled_device = load(config_file)
+    assert len(compiles) == 2
+    if name == "hold_time_def":
+        assert hold_time(compiled_device) == 0.5
+    if name == "universal_exit_key":
+        assert compiled_device[keysboard.exit_codes_tag] == {keysboard.get_key_code("KEY_Q"), keysboard.get_key_code("KEY_F12")}
+
+def test_other_compiler_inputs_change_the_digest(tmp_path, monkeypatch):
+    digest = keysboard.get_compiler_digest(str(tmp_path))
+    assert keysboard.get_compiler_digest(str(tmp_path)) == digest
+    assert keysboard.get_compiler_digest(str(tmp_path / "moved")) != digest
+    # The script, evdev and its key codes are hashed once, so changing them means starting over.
+    monkeypatch.setattr(keysboard, "compiler_digest_base", None)
+    monkeypatch.setitem(keysboard.ecodes.ecodes, "KEY_MADE_UP", 0x2ff)
+    assert keysboard.get_compiler_digest(str(tmp_path)) != digest
+
+def test_cache_from_another_compiler_is_ignored(config_file, compiles, monkeypatch):
+    load(config_file)
+    monkeypatch.setattr(keysboard, "get_compiler_digest", lambda base_dir: b"\0" * 20)
+    load(config_file)
+    assert len(compiles) == 2
+
+def test_broken_cache_is_ignored(config_file, compiles):
+    load(config_file)
+    with open(keysboard.get_config_cache_file(str(config_file)), "r+b") as f:
+        f.truncate(keysboard.config_cache_header.size + 3)
+    assert hold_time(load(config_file)) == keysboard.hold_time_def
+    assert len(compiles) == 2
+
+def test_compile_warnings_are_logged_again_from_the_cache(config_file, compiles, logged):
+    load(config_file)
+    warnings = list(logged)
+    assert any("KEY_NOT_A_KEY" in msg for level, device, layer, msg in warnings)
+    del logged[:]
+    load(config_file)
+    assert len(compiles) == 1
+    assert logged == warnings
@@ -0,0 +1,97 @@
+import json
+
+import pytest
+
+import keysboard
+
+
+@pytest.fixture
+def control_server(tmp_path):
+    config_file = str(tmp_path / "keysboard.json")
+    config_manager = keysboard.ConfigManager(config_file)
+    config_manager.set_config({keysboard.devices_tag: {"/dev/input/pad": {
+        keysboard.device_nickname_tag: "pad",
+        keysboard.layers_tag: {
+            "main": {keysboard.keybinds_tag: {"KEY_1": {keysboard.action_tag: "true"}}},
+            "music": {keysboard.keybinds_tag: {}}
+        }
+    }}})
+    return keysboard.ControlServer(str(tmp_path / "keysboard.sock"), config_manager)
+
+def send(control_server, request):
+    line = request if isinstance(request, bytes) else json.dumps(request).encode()
+    response = json.loads(control_server.handle_line(line))
+    assert response[keysboard.control_config_file_tag] == control_server.config_file
+    return response
+
+
+def test_ping(control_server):
+    assert send(control_server, {"command": "ping"})[keysboard.control_ok_tag] is True
+
+@pytest.mark.parametrize("line", [b"not json", b"[]", b'{"command": "explode"}', b'{"command": "set_layer", "device": "pad"}'])
+def test_bad_requests_are_answered_with_errors(control_server, line):
+    response = send(control_server, line)
+    assert response[keysboard.control_ok_tag] is False
+    assert response[keysboard.control_error_tag] != ""
+
+def test_requests_for_another_config_are_refused(control_server):
+    response = send(control_server, {"command": "ping", "config_file": "/somewhere/else.json"})
+    assert response[keysboard.control_ok_tag] is False
+
+def test_set_layer_by_nickname(control_server):
+    dispatcher = keysboard.DeviceDispatcher("/dev/input/pad", control_server.config_manager)
+    control_server.register(dispatcher)
+    assert send(control_server, {"command": "set_layer", "device": "pad", "layer": "music"})[keysboard.control_ok_tag] is True
+    assert dispatcher.current_layer.get_string() == "music"
+    assert send(control_server, {"command": "set_layer", "device": "pad", "layer": "nowhere"})[keysboard.control_ok_tag] is False
+    devices = send(control_server, {"command": "devices"})[keysboard.devices_tag]
+    assert devices["/dev/input/pad"]["layer"] == "music"
+
+def test_edits_apply_to_the_running_config_only(control_server):
+    response = send(control_server, {"command": "add_keybind", "device": "pad", "layer": "music", "key": "KEY_2", "action_type": "shell", "action": "echo hi"})
+    assert response[keysboard.control_ok_tag] is True
+    keymap = control_server.config_manager.get().devices["/dev/input/pad"][keysboard.keymaps_tag]["music"]
+    assert keymap[keysboard.get_key_code("KEY_2")] == ((keysboard.action_shell_tag, "echo hi"),)
+    assert send(control_server, {"command": "remove_keybind", "device": "pad", "layer": "main", "key": "KEY_1"})[keysboard.control_ok_tag] is True
+    assert control_server.config_manager.get().devices["/dev/input/pad"][keysboard.keymaps_tag]["main"] == {}
+
+def test_invalid_edits_keep_the_running_config(control_server):
+    devices = control_server.config_manager.get().devices
+    response = send(control_server, {"command": "add_keybind", "device": "pad", "layer": "main", "key": "KEY_2", "action_type": "exec", "action": " "})
+    assert response[keysboard.control_ok_tag] is False
+    assert control_server.config_manager.get().devices is devices
+
+def test_failing_commands_are_answered_with_errors(control_server, logged):
+    control_server.commands["ping"] = lambda request: 1 / 0
+    response = send(control_server, {"command": "ping"})
+    assert response[keysboard.control_ok_tag] is False
+    assert len(logged) == 1
+
+def test_socket_is_owner_only_and_answers(control_server):
+    assert control_server.start()
+    try:
+        assert keysboard.stat.S_IMODE(keysboard.os.stat(control_server.socket_file).st_mode) == 0o600
+        response = keysboard.send_control({"command": "ping"}, control_server.socket_file)
+        assert response[keysboard.control_ok_tag] is True
+    finally:
+        control_server.stop()
+    assert not keysboard.os.path.exists(control_server.socket_file)
+
+def test_stale_sockets_are_replaced(control_server):
+    stale = keysboard.socket.socket(keysboard.socket.AF_UNIX, keysboard.socket.SOCK_STREAM)
+    stale.bind(control_server.socket_file)
+    stale.close()
+    assert control_server.start()
+    control_server.stop()
+
+@pytest.mark.parametrize("link", [False, True])
+def test_other_files_at_the_socket_path_are_left_alone(control_server, tmp_path, logged, link):
+    notes = tmp_path / "notes.txt"
+    notes.write_text("keep me")
+    if link:
+        keysboard.os.symlink(notes, control_server.socket_file)
+    else:
+        control_server.socket_file = str(notes)
+    assert not control_server.start()
+    assert notes.read_text() == "keep me"
+    assert [level for level, device, layer, msg in logged] == [keysboard.log_error]
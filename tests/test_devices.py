@@ -0,0 +1,36 @@
+from threading import Thread
+
+import keysboard
+
+
+def test_waiting_stops_with_the_last_attached_device():
+    watcher = keysboard.DeviceWatcher()
+    attached = []
+    watcher.attached_listener = attached.append
+    watcher.attach()
+    watcher.attach()
+    watcher.detach(True)
+    assert not watcher.stopping
+    # Unplugged devices wait to come back.
+    watcher.detach(False)
+    assert not watcher.stopping
+    watcher.attach()
+    changes = watcher.changes
+    watcher.detach(True)
+    assert watcher.stopping
+    assert watcher.changes > changes
+    assert attached == [1, 2, 1, 0, 1, 0]
+
+def test_waiting_devices_stop_once_the_attached_ones_did(tmp_path):
+    config_manager = keysboard.ConfigManager()
+    missing = str(tmp_path / "event9")
+    config_manager.set_config({keysboard.devices_tag: {missing: {keysboard.layers_tag: {"main": {keysboard.keybinds_tag: {}}}}}})
+    watcher = keysboard.DeviceWatcher()
+    result = []
+    thread = Thread(target=lambda: result.append(keysboard.run_device(missing, config_manager, keysboard.KeyScheduler(), keysboard.ProcessRunner(), device_watcher=watcher)), daemon=True)
+    thread.start()
+    # Another device attaches and stops on its exit key.
+    watcher.attach()
+    watcher.detach(True)
+    thread.join(5)
+    assert result == [True]
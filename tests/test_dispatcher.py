@@ -0,0 +1,106 @@
+import pytest
+
+import keysboard
+
+
+class Event():
+    def __init__(self, code, value=1):
+        self.type = keysboard.ecodes.EV_KEY
+        self.code = code
+        self.value = value
+
+    def timestamp(self):
+        return keysboard.time()
+
+def make_dispatcher(layers, **device_config):
+    config_manager = keysboard.ConfigManager()
+    config_manager.set_config({keysboard.devices_tag: {"pad": {keysboard.layers_tag: layers, **device_config}}})
+    return keysboard.DeviceDispatcher("pad", config_manager, keysboard.RecordingActions())
+
+def press(dispatcher, key, value=1):
+    dispatcher.handle_event(Event(keysboard.get_key_code(key), value))
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(keysboard, "monotonic", lambda: now[0])
+    return now
+
+def repeating(action, repeat_rate=10, **options):
+    return {keysboard.action_tag: action, keysboard.repeat_rate_tag: repeat_rate, **options}
+
+
+def test_layers_binding_the_same_key_are_throttled_separately():
+    dispatcher = make_dispatcher({
+        "main": {keysboard.keybinds_tag: {
+            "KEY_1": {keysboard.action_tag: "main", keysboard.debounce_tag: 60},
+            "KEY_2": {keysboard.action_type_tag: keysboard.action_set_layer_tag, keysboard.action_tag: "music"}
+        }},
+        "music": {keysboard.keybinds_tag: {"KEY_1": {keysboard.action_tag: "music", keysboard.debounce_tag: 60}}}
+    })
+    for key in ("KEY_1", "KEY_1", "KEY_2", "KEY_1", "KEY_1"):
+        press(dispatcher, key)
+    assert dispatcher.actions.actions == [(keysboard.action_shell_tag, "main"), (keysboard.action_shell_tag, "music")]
+
+def test_held_keys_repeat_at_their_rate_until_released(clock):
+    dispatcher = make_dispatcher({"main": {keysboard.keybinds_tag: {"KEY_1": repeating("again"), "KEY_2": {keysboard.action_tag: "once"}}}})
+    assert dispatcher.repeat_timeout() is None
+    press(dispatcher, "KEY_1")
+    press(dispatcher, "KEY_2")
+    assert dispatcher.repeat_timeout() == pytest.approx(0.1)
+    # The kernel's autorepeat doesn't run anything, with or without a repeat_rate.
+    press(dispatcher, "KEY_1", 2)
+    press(dispatcher, "KEY_2", 2)
+    dispatcher.repeat_held()
+    assert len(dispatcher.actions.actions) == 2
+    for step in range(3):
+        clock[0] += 0.1
+        dispatcher.repeat_held()
+    assert [action for action_type, action in dispatcher.actions.actions] == ["again", "once", "again", "again", "again"]
+    press(dispatcher, "KEY_1", 0)
+    assert dispatcher.repeat_timeout() is None
+    clock[0] += 1
+    dispatcher.repeat_held()
+    assert len(dispatcher.actions.actions) == 5
+
+def test_repeats_missed_while_busy_are_skipped(clock):
+    dispatcher = make_dispatcher({"main": {keysboard.keybinds_tag: {"KEY_1": repeating("again")}}})
+    press(dispatcher, "KEY_1")
+    clock[0] += 0.55
+    dispatcher.repeat_held()
+    assert len(dispatcher.actions.actions) == 2
+    assert dispatcher.repeat_timeout() == pytest.approx(0.1)
+
+def test_debounced_presses_dont_repeat(clock):
+    dispatcher = make_dispatcher({"main": {keysboard.keybinds_tag: {"KEY_1": repeating("again", **{keysboard.debounce_tag: 1})}}})
+    press(dispatcher, "KEY_1")
+    press(dispatcher, "KEY_1", 0)
+    clock[0] += 0.2
+    press(dispatcher, "KEY_1")
+    assert dispatcher.repeat_timeout() is None
+    assert len(dispatcher.actions.actions) == 1
+
+def test_switching_layers_stops_repeats(clock):
+    dispatcher = make_dispatcher({
+        "main": {keysboard.keybinds_tag: {"KEY_1": repeating("main"), "KEY_2": {keysboard.action_type_tag: keysboard.action_set_layer_tag, keysboard.action_tag: "music"}}},
+        "music": {keysboard.keybinds_tag: {"KEY_1": repeating("music")}}
+    })
+    press(dispatcher, "KEY_1")
+    press(dispatcher, "KEY_2")
+    clock[0] += 0.1
+    dispatcher.repeat_held()
+    assert dispatcher.actions.actions == [(keysboard.action_shell_tag, "main")]
+    assert dispatcher.repeat_timeout() is None
+
+def test_repeats_wait_for_runs_in_flight(clock):
+    dispatcher = make_dispatcher({"main": {keysboard.keybinds_tag: {"KEY_1": repeating("again", **{keysboard.max_in_flight_tag: 1})}}})
+    finished = []
+    dispatcher.actions.run_shell = lambda cmd, device="", current_layer="", print_output=True, trace=None, done=None: finished.append(done)
+    press(dispatcher, "KEY_1")
+    clock[0] += 0.1
+    dispatcher.repeat_held()
+    assert len(finished) == 1
+    finished[0]()
+    clock[0] += 0.1
+    dispatcher.repeat_held()
+    assert len(finished) == 2
@@ -0,0 +1,93 @@
+from threading import Event
+
+from conftest import RecordingOutput
+
+import keysboard
+
+
+def tap(code, hold_time=0.0):
+    return (hold_time, ((0.0, ((code, 1),)), (hold_time, ((code, 0),))))
+
+
+def test_frames_play_in_order_as_one_report_each(output):
+    scheduler = keysboard.KeyScheduler()
+    chord = (0.01, ((0.0, ((29, 1), (30, 1))), (0.01, ((30, 0), (29, 0)))))
+    assert scheduler.play(output, chord)
+    scheduler.wait()
+    assert output.reports == [[(29, 1), (30, 1)], [(30, 0), (29, 0)]]
+
+def test_actions_on_one_output_never_interleave(output):
+    scheduler = keysboard.KeyScheduler()
+    for code in (2, 3, 4):
+        scheduler.play(output, tap(code, 0.01))
+    scheduler.wait()
+    assert output.reports == [[(2, 1)], [(2, 0)], [(3, 1)], [(3, 0)], [(4, 1)], [(4, 0)]]
+
+def test_outputs_play_side_by_side():
+    reports = []
+    first, second = RecordingOutput(reports), RecordingOutput(reports)
+    scheduler = keysboard.KeyScheduler()
+    scheduler.play(first, tap(2, 0.05))
+    scheduler.play(second, tap(3, 0.05))
+    scheduler.wait()
+    # Both presses are due right away, in the order they were queued, before either release.
+    assert reports[:2] == [[(2, 1)], [(3, 1)]]
+
+def test_drop_policy_drops_new_actions_when_full(output):
+    scheduler = keysboard.KeyScheduler(2, keysboard.full_policy_drop_tag)
+    finished = []
+    results = [scheduler.play(output, tap(code, 0.05), done=lambda code=code: finished.append(code)) for code in (2, 3, 4, 5)]
+    scheduler.wait()
+    assert results == [True, True, False, False]
+    assert [report[0][0] for report in output.reports[::2]] == [2, 3]
+    assert sorted(finished) == [2, 3, 4, 5]
+    assert scheduler.stats()["dropped"] == 2
+
+def test_coalesce_policy_replaces_the_newest_waiting_action(output):
+    scheduler = keysboard.KeyScheduler(2, keysboard.full_policy_coalesce_tag)
+    finished = []
+    results = [scheduler.play(output, tap(code, 0.05), done=lambda code=code: finished.append(code)) for code in (2, 3, 4, 5)]
+    scheduler.wait()
+    assert results == [True, True, True, True]
+    # 2 was already playing, 3 and then 4 were replaced while waiting, last one wins.
+    assert [report[0][0] for report in output.reports[::2]] == [2, 5]
+    assert sorted(finished) == [2, 3, 4, 5]
+    stats = scheduler.stats()
+    assert (stats["played"], stats["dropped"], stats["coalesced"]) == (2, 0, 2)
+
+def test_slow_writes_dont_block_queueing_or_stats(output):
+    writing, unblock = Event(), Event()
+    class SlowOutput(RecordingOutput):
+        def write(self, event_type, code, value):
+            writing.set()
+            unblock.wait(5)
+            super().write(event_type, code, value)
+    slow = SlowOutput()
+    scheduler = keysboard.KeyScheduler()
+    scheduler.play(slow, tap(2))
+    assert writing.wait(5)
+    # The scheduler thread is stuck in the write, so only these threads can get anything done.
+    assert scheduler.stats()["running"] == 1
+    assert scheduler.play(output, tap(3))
+    assert scheduler.play(slow, tap(4))
+    unblock.set()
+    scheduler.wait()
+    assert [report[0][0] for report in slow.reports[::2]] == [2, 4]
+    assert output.reports == [[(3, 1)], [(3, 0)]]
+
+def test_failing_writes_drop_the_action(logged):
+    class FailingOutput(RecordingOutput):
+        def write(self, event_type, code, value):
+            raise OSError("no uinput")
+    finished = []
+    scheduler = keysboard.KeyScheduler()
+    scheduler.play(FailingOutput(), tap(2), done=lambda: finished.append(True))
+    scheduler.wait()
+    assert finished == [True]
+    assert len(logged) == 1
+
+def test_bad_executor_settings_fall_back_to_defaults(logged):
+    scheduler = keysboard.get_key_scheduler({keysboard.executor_tag: {keysboard.queue_depth_tag: "lots", keysboard.full_policy_tag: "shuffle", keysboard.workers_tag: 4}})
+    assert scheduler.queue_depth == keysboard.executor_queue_depth_def
+    assert scheduler.full_policy == keysboard.executor_full_policy_def
+    assert len(logged) == 3
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+import keysboard
+
+
+def write_csv(path, *rows):
+    path.write_text("device,layer,key,action_type,action\n" + "".join(row + "\n" for row in rows))
+    return str(path)
+
+def actions(keybinds):
+    return [keybind[keysboard.action_tag] for keybind in keybinds]
+
+
+def test_csv_shell_actions_are_kept_as_written(tmp_path):
+    keybinds = keysboard.read_keybinds(write_csv(tmp_path / "binds.csv",
+        "pad,main,KEY_1,,[ -f /tmp/x ] && echo hi",
+        "pad,main,KEY_2,shell,{ echo a; echo b; }",
+        "pad,main,KEY_3,set_layer,[music]"))
+    assert actions(keybinds) == ["[ -f /tmp/x ] && echo hi", "{ echo a; echo b; }", "[music]"]
+
+def test_csv_structured_actions_are_decoded(tmp_path):
+    keybinds = keysboard.read_keybinds(write_csv(tmp_path / "binds.csv",
+        'pad,main,KEY_1,exec,"[""notify-send"", ""hi""]"',
+        'pad,main,KEY_2,keyboard,"{""key"": ""KEY_A""}"',
+        'pad,main,KEY_3,multi,"[{""action"": ""true""}]"',
+        "pad,main,KEY_4,exec,[ -f /tmp/x ]"))
+    assert actions(keybinds) == [["notify-send", "hi"], {"key": "KEY_A"}, [{"action": "true"}], "[ -f /tmp/x ]"]
+
+def test_json_keybinds(tmp_path):
+    path = tmp_path / "binds.json"
+    path.write_text(json.dumps([{"device": "pad", "layer": "main", "key": "KEY_1", "action_type": "exec", "action": ["true"]}]))
+    assert actions(keysboard.read_keybinds(str(path))) == [["true"]]
+
+@pytest.mark.parametrize("content", ['{"device": "pad"}', '[{"device": "pad", "layer": "main", "action": "true"}]', '["pad"]'])
+def test_invalid_json_keybinds_are_rejected(tmp_path, content):
+    path = tmp_path / "binds.json"
+    path.write_text(content)
+    with pytest.raises(ValueError):
+        keysboard.read_keybinds(str(path))
+
+def test_csv_rows_need_every_field(tmp_path):
+    with pytest.raises(ValueError):
+        keysboard.read_keybinds(write_csv(tmp_path / "binds.csv", "pad,main,,shell,true"))
+
+def test_import_adds_layers_and_devices_without_sample_binds(tmp_path):
+    config_file = str(tmp_path / "keysboard.json")
+    keysboard.save_config({keysboard.devices_tag: {"old": keysboard.blank_device()}}, config_file)
+    count = keysboard.import_keybinds(write_csv(tmp_path / "binds.csv",
+        "old,extra,KEY_1,,echo one",
+        "new,music,KEY_2,,echo two"), config_file)
+    assert count == 2
+    with open(config_file) as f:
+        devices = json.load(f)[keysboard.devices_tag]
+    assert devices["old"][keysboard.layers_tag][keysboard.first_layer_def] == keysboard.blank_layer()
+    assert devices["old"][keysboard.layers_tag]["extra"][keysboard.keybinds_tag] == {"KEY_1": {keysboard.action_type_tag: keysboard.action_shell_tag, keysboard.action_tag: "echo one"}}
+    assert list(devices["new"][keysboard.layers_tag]) == ["music"]
+    assert devices["new"][keysboard.layers_tag]["music"][keysboard.keybinds_tag] == {"KEY_2": {keysboard.action_type_tag: keysboard.action_shell_tag, keysboard.action_tag: "echo two"}}
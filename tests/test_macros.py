@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+import keysboard
+
+
+def frames(timeline):
+    return [timeline[1][index] for index in range(len(timeline[1]))]
+
+
+def test_macros_round_trip(tmp_path):
+    macro_file = str(tmp_path / "macros" / "hello.kbm")
+    keysboard.write_macro(macro_file, [30, 31, 30, 31], [1, 1, 0, 0], [0, 0, 250000, 500000])
+    codes, states, delays = keysboard.read_macro(macro_file)
+    assert (list(codes), list(states), list(delays)) == ([30, 31, 30, 31], [1, 1, 0, 0], [0, 0, 250000, 500000])
+    assert [name for name in os.listdir(tmp_path / "macros")] == ["hello.kbm"]
+
+def test_macro_timelines_group_events_recorded_together(tmp_path):
+    macro_file = str(tmp_path / "hello.kbm")
+    keysboard.write_macro(macro_file, [30, 31, 30, 31], [1, 1, 0, 0], [0, 0, 250000, 500000])
+    duration, macro_frames = timeline = keysboard.get_macro_timeline(macro_file)
+    assert duration == 0.75
+    assert frames(timeline) == [(0.0, ((30, 1), (31, 1))), (0.25, ((30, 0),)), (0.75, ((31, 0),))]
+    fast = keysboard.get_macro_timeline(macro_file, 2.0)
+    assert fast[0] == 0.375
+    assert [offset for offset, events in frames(fast)] == [0.0, 0.125, 0.375]
+    # Loaded once per file and speed.
+    assert keysboard.get_macro_timeline(macro_file) is timeline
+
+def test_changed_macros_are_loaded_again(tmp_path):
+    macro_file = str(tmp_path / "hello.kbm")
+    keysboard.write_macro(macro_file, [30, 30], [1, 0], [0, 100000])
+    keysboard.get_macro_timeline(macro_file)
+    keysboard.write_macro(macro_file, [31, 31, 31], [1, 0, 1], [0, 100000, 100000])
+    os.utime(macro_file, ns=(1, 1))
+    assert frames(keysboard.get_macro_timeline(macro_file)) == [(0.0, ((31, 1),)), (0.1, ((31, 0),)), (0.2, ((31, 1),))]
+
+@pytest.mark.parametrize("content", [b"", b"KBMR", b"XXXX\x01\x00\x00\x00\x00\x00", keysboard.macro_header.pack(keysboard.macro_magic, keysboard.macro_version, 5) + b"\x00" * 4])
+def test_broken_macros_are_rejected(tmp_path, content):
+    macro_file = tmp_path / "broken.kbm"
+    macro_file.write_bytes(content)
+    with pytest.raises(ValueError):
+        keysboard.read_macro(str(macro_file))
+
+def test_macro_binds_play_through_the_key_scheduler(tmp_path, output):
+    keysboard.write_macro(str(tmp_path / "hello.kbm"), [30, 30], [1, 0], [0, 10000])
+    compiled_device = keysboard.compile_devices({keysboard.devices_tag: {"pad": {keysboard.layers_tag: {"main": {keysboard.keybinds_tag: {
+        "KEY_1": {keysboard.action_type_tag: keysboard.action_macro_tag, keysboard.action_tag: "hello.kbm"}
+    }}}}}}, str(tmp_path))["pad"]
+    (action_type, (macro_file, speed)), = compiled_device[keysboard.keymaps_tag]["main"][keysboard.get_key_code("KEY_1")]
+    assert (action_type, macro_file, speed) == (keysboard.action_macro_tag, str(tmp_path / "hello.kbm"), 1.0)
+    scheduler = keysboard.KeyScheduler()
+    scheduler.play(output, keysboard.get_macro_timeline(macro_file, speed))
+    scheduler.wait()
+    assert output.reports == [[(30, 1)], [(30, 0)]]
@@ -0,0 +1,48 @@
+import pytest
+
+import keysboard
+
+
+def test_commands_past_the_queue_depth_are_dropped_per_device():
+    runner = keysboard.ProcessRunner(2)
+    finished = []
+    pids = [runner.spawn(("sleep", "0.2"), "pad", print_output=False, done=lambda n=n: finished.append(n)) for n in range(3)]
+    assert pids[0] is not None and pids[1] is not None and pids[2] is None
+    assert finished == [2]
+    assert runner.spawn(("sleep", "0.2"), "other", print_output=False) is not None
+    assert runner.stats()["running"] == 3
+    runner.wait()
+    assert sorted(finished) == [0, 1, 2]
+    assert runner.stats() == {"running": 0, "spawned": 3, "failed": 0, "dropped": 1}
+    # Reaped children free their slots again.
+    assert runner.spawn(("true",), "pad", print_output=False) is not None
+    runner.wait()
+
+def test_failed_commands_are_counted():
+    runner = keysboard.ProcessRunner(1)
+    with pytest.raises(OSError):
+        runner.spawn(("keysboard-no-such-command",), "pad")
+    runner.spawn(("false",), "pad", print_output=False)
+    runner.wait()
+    assert runner.stats() == {"running": 0, "spawned": 1, "failed": 2, "dropped": 0}
+
+def test_children_are_reaped_and_their_output_logged(logged):
+    runner = keysboard.ProcessRunner()
+    finished = []
+    pid = runner.spawn(("sh", "-c", "echo one; echo two"), "pad", "main", done=lambda: finished.append("printed"))
+    assert pid > 0
+    runner.spawn(("true",), "pad", print_output=False, done=lambda: finished.append("quiet"))
+    runner.wait()
+    assert sorted(finished) == ["printed", "quiet"]
+    assert logged == [(keysboard.log_info, "pad", "main", "Command output: [ one|two ]")]
+    # Reaped means waited for, nothing is left to reap.
+    with pytest.raises(ChildProcessError):
+        keysboard.os.waitpid(pid, keysboard.os.WNOHANG)
+
+def test_children_are_reaped_without_pidfds(monkeypatch):
+    monkeypatch.delattr(keysboard.os, "pidfd_open")
+    runner = keysboard.ProcessRunner()
+    finished = []
+    runner.spawn(("true",), print_output=False, done=lambda: finished.append(True))
+    runner.wait()
+    assert finished == [True]
@@ -0,0 +1,57 @@
+import json
+
+import keysboard
+
+
+def test_histogram_buckets_and_percentiles():
+    histogram = keysboard.Histogram()
+    for seconds in (0.0005, 0.0005, 0.0005, 0.003, -1.0):
+        histogram.add(seconds)
+    assert histogram.count == 5
+    assert histogram.max == 0.003
+    # 500 us falls in the bucket under 512 us, negative latencies count as 0.
+    assert histogram.buckets[0] == 1 and histogram.buckets[9] == 3 and histogram.buckets[12] == 1
+    assert histogram.percentile(0.5) == 0.512
+    assert histogram.percentile(1.0) == 3.0
+    summary = histogram.summary()
+    assert (summary["count"], summary["max_ms"], summary["buckets_us"]) == (5, 3.0, {"1": 1, "512": 3, "4096": 1})
+
+def test_histograms_merge_exactly():
+    first, second, merged = keysboard.Histogram(), keysboard.Histogram(), keysboard.Histogram()
+    for seconds in (0.001, 0.002):
+        first.add(seconds)
+    second.add(0.05)
+    for histogram in (first, second):
+        merged.merge(histogram.buckets, histogram.count, histogram.total, histogram.max)
+    expected = keysboard.Histogram()
+    for seconds in (0.001, 0.002, 0.05):
+        expected.add(seconds)
+    assert merged.summary() == expected.summary()
+
+def test_stats_from_other_processes_are_merged(tmp_path):
+    main = keysboard.LatencyStats(str(tmp_path / "stats.json"))
+    worker = keysboard.LatencyStats(None)
+    main.record("pad", "main", keysboard.action_shell_tag, keysboard.stage_queue_tag, 0.001)
+    worker.record("pad", "main", keysboard.action_shell_tag, keysboard.stage_queue_tag, 0.004)
+    worker.record("knob", "main", keysboard.action_keyboard_tag, keysboard.stage_output_tag, 0.002)
+    main.counters["keyboard"] = lambda: {"played": 2, "dropped": 1}
+    worker.counters["keyboard"] = lambda: {"played": 3, "dropped": 0}
+    # Worker dumps travel as JSON through a pipe.
+    main.set_source(1234, json.loads(json.dumps(worker.dump_raw())))
+    main.write()
+    with open(tmp_path / "stats.json") as f:
+        stats = json.load(f)
+    pad = stats[keysboard.stats_devices_tag]["pad"][keysboard.stage_queue_tag]
+    assert (pad["count"], pad["max_ms"]) == (2, 4.0)
+    assert stats[keysboard.stats_layers_tag]["knob / main"][keysboard.stage_output_tag]["count"] == 1
+    assert stats[keysboard.stats_actions_tag][keysboard.action_shell_tag][keysboard.stage_queue_tag]["count"] == 2
+    assert stats["keyboard"] == {"played": 5, "dropped": 1}
+
+def test_traces_record_every_scope():
+    stats = keysboard.LatencyStats(None)
+    keysboard.record_trace((stats, "pad", "main", keysboard.action_exec_tag, keysboard.monotonic()), keysboard.stage_action_start_tag)
+    keysboard.record_trace(None, keysboard.stage_action_start_tag)
+    dump = stats.dump()
+    assert dump[keysboard.stats_devices_tag]["pad"][keysboard.stage_action_start_tag]["count"] == 1
+    assert dump[keysboard.stats_layers_tag]["pad / main"][keysboard.stage_action_start_tag]["count"] == 1
+    assert dump[keysboard.stats_actions_tag][keysboard.action_exec_tag][keysboard.stage_action_start_tag]["count"] == 1